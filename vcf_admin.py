@@ -1,7 +1,13 @@
 #!/usr/bin/env python
 
 from __future__ import print_function
-import re
+import re, sys, time, threading
+from collections import deque
+from multiprocessing.pool import ThreadPool
+from vcf_bgzf import BgzfWriter
+from vcf_query import check_position_index, parse_region, region_query, init_metadata_tables, \
+	collection_vcfs, collection_samples, collection_file_keys, file_key, delete_vcfs, delete_samples, upgrade_metadata, \
+	create_field_index, field_index_name, allele_stats, collection_sample_stats, update_stats_totals, SAMPLE_STATS
 try:
 	import rethinkdb as r
 except:
@@ -14,6 +20,8 @@ class BadDatabase(Exception):
 	pass
 class BadCollection(Exception):
 	pass
+class FailedWrite(Exception):
+	pass
 
 
 def main():
@@ -30,16 +38,31 @@ def main():
 	parser.add_argument('--db', default='VCF', 
 		help='Database name where the VCF data is stored. Defaults to `VCF`.')
 
-	parser.add_argument('command', choices=['help', 'list', 'check', 'fix', 'rename', 'copy', 'delete'], 
+	parser.add_argument('command', choices=['help', 'list', 'check', 'fix', 'rename', 'copy', 'delete', 'export', 'index-field',
+		'remove-samples', 'remove-vcf'], 
 		help='The operation that must be performed.')
 	
 	parser.add_argument('options', nargs='*',  
 		help='Options for the selected command. Use the help command to know more about each command.')
 	
 	parser.add_argument('-f', action='store_true',
-		help='Execute a fix or delete command without requiring a confirmation.')
+		help='Execute a fix, delete or remove command without requiring a confirmation.')
+
+	parser.add_argument('--samples', nargs='+',
+		help='Export only the selected samples. Defaults to all samples in the collection.')
+
+	parser.add_argument('--region',
+		help='Export only records inside a region, eg: `20`, `20:1000000` or `20:1000000-2000000`.')
+
+	parser.add_argument('-o', '--output',
+		help='Destination file for the export command. Defaults to `<collection>.vcf.gz`. Names ending in `.gz` are BGZF-compressed.')
+
+	parser.add_argument('--batch-size', default=1000, type=int,
+		help='How many records are read (and written) at a time by the export, copy, fix and remove commands. Defaults to 1000.')
+
+	parser.add_argument('--workers', default=4, type=int,
+		help='How many queries the copy and remove commands keep running in parallel. Defaults to 4.')
 
-	
 
 	args = parser.parse_args()
 
@@ -61,10 +84,35 @@ def main():
 		print('rename old new      Rename a collection.')
 		print('')
 		print('copy source dest    Create a copy of a collection.')
-		print('                    Indexes are not copied.')
+		print('                    Indexes are rebuilt on the copy.')
+		print('                    An interrupted copy is resumed by')
+		print('                    running the same command again.')
 		print('')
 		print('delete name [-f]    Delete a collection. If `-f` is not')
 		print('                    specified, requires confirmation.')
+		print('')
+		print('export collection [--samples ...] [--region ...] [-o file]')
+		print('                    Write a collection (or a subset of')
+		print('                    its samples and records) back to a')
+		print('                    multi-sample VCF file.')
+		print('')
+		print('index-field collection INFO:ID|FORMAT:ID')
+		print('                    Build a secondary index over the')
+		print('                    values of an INFO or FORMAT field')
+		print('                    (from all files and samples), to')
+		print('                    query records by value ranges.')
+		print('')
+		print('remove-samples collection sample [sample ...] [-f]')
+		print('                    Remove the data of some samples.')
+		print('                    Records left without samples are')
+		print('                    deleted, privates index files are')
+		print('                    rebuilt.')
+		print('')
+		print('remove-vcf collection file [file ...] [-f]')
+		print('                    Remove the data of some VCF files')
+		print('                    and of their samples. Records left')
+		print('                    without files are deleted, privates')
+		print('                    index files are rebuilt.')
 		return
 
 	# from this point onward a db connection is required
@@ -80,6 +128,7 @@ def main():
 	except BadDatabase as e:
 		print('Bad database:', e)
 		exit(1)
+	init_metadata_tables(db_connection)
 
 
 	### COMMANDS ###
@@ -105,12 +154,28 @@ def main():
 			print('Bad collection:', e)
 			exit(1)
 		print('# Listing metadata about collection {}:'.format(args.options[0]))
-		print('\n### VCF FILES ###')
-		for vcf in metadata['vcfs']:
+		print('\n### VCF FILES ({}) ###'.format(metadata['vcfs_count']))
+		for vcf in sorted(collection_vcfs(db_connection, args.options[0])):
 			print(vcf)
-		print('\n### SAMPLES ###')
-		for sample in metadata['samples']:
-			print(sample)
+		print('\n### SAMPLES ({}) ###'.format(metadata['samples_count']))
+		sample_stats = collection_sample_stats(db_connection, args.options[0])
+		if sample_stats:
+			print('SAMPLE'.ljust(18), '\t'.join(key.upper() for key in SAMPLE_STATS), '\tTI/TV', sep='\t')
+		for sample in sorted(collection_samples(db_connection, args.options[0])):
+			if sample in sample_stats:
+				print(sample.ljust(18), '\t'.join(str(sample_stats[sample][key]) for key in SAMPLE_STATS), 
+					ti_tv(sample_stats[sample]), sep='\t')
+			else:
+				print(sample)
+		if metadata.get('stats'):
+			print('\n### SUMMARY ###')
+			for key in SAMPLE_STATS:
+				print('{}: {}'.format(key.replace('_', ' '), metadata['stats'][key]))
+			print('Ti/Tv: {}'.format(ti_tv(metadata['stats'])))
+		if metadata.get('field_indexes'):
+			print('\n### INDEXED FIELDS ###')
+			for field, value_type in sorted(metadata['field_indexes'].items()):
+				print('{} ({}, index {})'.format(field, value_type, field_index_name(field)))
 		print('')
 		exit(0)
 
@@ -189,10 +254,13 @@ def main():
 				exit(1)
 
 		try:
-			result = do_fix(db_connection, args.options[0])
+			result = do_fix(db_connection, args.options[0], batch_size=args.batch_size)
 		except BadCollection as e:
 			print('Bad collection:', e)
 			exit(1)
+		except FailedWrite as e:
+			print('\nFailed write:', e)
+			exit(1)
 
 		if result is None:
 			print('This collection is in a consistent state, nothing to do here.')
@@ -202,6 +270,11 @@ def main():
 			print('This collection had a pending initial import; it has been deleted.')
 			exit(0)
 
+		if result[0] == 'removing':
+			print('This collection had a pending removal; it has been completed.')
+			print('Total records: {} deleted, {} updated.'.format(*result[1]))
+			exit(0)
+
 		#else
 		bad_vcf, bad_samples, deleted_records, reverted_records = result
 
@@ -215,6 +288,53 @@ def main():
 		exit(0)
 
 
+	if args.command == 'index-field':
+		if not len(args.options) == 2:
+			print("Must be called with a collection name and a field, eg: `INFO:DP` or `FORMAT:GQ`.")
+			exit(1)
+
+		try:
+			print('Building the index, this might take a while.')
+			name, value_type = do_index_field(db_connection, args.options[0], args.options[1])
+		except BadCollection as e:
+			print('Bad collection:', e)
+			exit(1)
+		except ValueError as e:
+			print('Bad field:', e)
+			exit(1)
+
+		print('Built index {} over the {} values of {}.'.format(name, value_type, args.options[1]))
+		exit(0)
+
+
+	if args.command in ('remove-samples', 'remove-vcf'):
+		what = 'samples' if args.command == 'remove-samples' else 'VCF files'
+		if not len(args.options) >= 2:
+			print("Must be called with a collection name and the {} to remove.".format(what))
+			exit(1)
+
+		if not args.f:
+			print('WARNING: *THIS OPERATION CANNOT BE UNDONE*')
+			name = raw_input('To confirm, please type again the name of the collection you want to remove {} from:\n'.format(what))
+			if name != args.options[0]:
+				print('Name does not match, aborting.')
+				exit(1)
+
+		removal = {'samples': args.options[1:]} if args.command == 'remove-samples' else {'vcfs': args.options[1:]}
+		try:
+			deleted_records, updated_records = do_remove(db_connection, args.options[0], batch_size=args.batch_size, 
+				workers=args.workers, **removal)
+		except BadCollection as e:
+			print('Bad collection:', e)
+			exit(1)
+		except FailedWrite as e:
+			print('\nFailed write:', e)
+			print('Run the command again (or fix) to complete the removal.')
+			exit(1)
+		print('\nTotal records: {} deleted, {} updated.'.format(deleted_records, updated_records))
+		exit(0)
+
+
 	if args.command == 'rename':
 		if not len(args.options) == 2:
 			print("Must be called with old and new collection names as parameters (in that order).")
@@ -225,28 +345,33 @@ def main():
 		exit(0)
 
 	if args.command == 'copy':
-		if not len(options) == 2:
+		if not len(args.options) == 2:
 			print("Must be called with source and destination collection names as parameters (in that order).")
 			exit(1)
 
 		try:
-			records = do_copy(db_connection, args.options)
+			records = do_copy(db_connection, args.options[0], args.options[1], 
+						batch_size=args.batch_size, workers=args.workers)
 		except BadCollection as e:
 			print('Bad collection:', e)
 			exit(1)
-		print('Total copied records: {}.'.format(records))
+		except FailedWrite as e:
+			print('\nFailed write:', e)
+			print('Run the command again to resume the copy.')
+			exit(1)
+		print('\nTotal copied records: {}.'.format(records))
 		exit(0)
 
 
 	if args.command == 'delete':
-		if not len(options) == 1:
+		if not len(args.options) == 1:
 			print("This command requires the name of the collection to be deleted as parameter with an optional `-f` flag.")
 			exit(1)
 		
 		if not args.f:
 			print('WARNING: *THIS OPERATION CANNOT BE UNDONE*')
 			name = raw_input('To confirm, please type again the name of the collection you want to delete:\n')
-			if name != options[0]:
+			if name != args.options[0]:
 				print('Name does not match, aborting.')
 				exit(1)
 		try:
@@ -262,6 +387,40 @@ def main():
 		exit(0)
 
 
+	if args.command == 'export':
+		if not len(args.options) == 1:
+			print("This command requires the name of the collection to be exported as parameter.")
+			exit(1)
+
+		output = args.output or '{}.vcf.gz'.format(args.options[0])
+		if output.endswith('.gz'):
+			out_stream = BgzfWriter(open(output, 'wb'))
+		else:
+			out_stream = open(output, 'w')
+
+		try:
+			records = do_export(db_connection, args.options[0], out_stream, 
+						samples=args.samples, region=args.region, batch_size=args.batch_size)
+		except BadCollection as e:
+			print('Bad collection:', e)
+			exit(1)
+		except ValueError as e:
+			print('Bad region:', e)
+			exit(1)
+		finally:
+			out_stream.close()
+
+		print('Total exported records: {}.'.format(records))
+		exit(0)
+
+
+
+def ti_tv(stats):
+	if not stats['transversions']:
+		return '-'
+	return '{:.2f}'.format(stats['transitions'] / float(stats['transversions']))
+
+
 
 def do_list(db, collection=None):
 	if collection is None:
@@ -269,7 +428,7 @@ def do_list(db, collection=None):
 	#else
 	check_collection_name(collection)
 
-	metadata = r.table('__METADATA__').get(collection).run(db)
+	metadata = upgrade_metadata(db, r.table('__METADATA__').get(collection).run(db))
 	if metadata is None:
 		raise BadCollection('collection {} has no metadata.'. format(collection))
 	return metadata
@@ -287,12 +446,17 @@ def do_check(db):
 				inconsistent_collections.append((m, 'doing init'))
 			elif m.get('appending_filenames'):
 				inconsistent_collections.append((m, 'appending [{}]'.format(', '.join(m['appending_filenames']))))
+			elif m.get('copying_from'):
+				inconsistent_collections.append((m, 'copying from {}'.format(m['copying_from'])))
+			elif m.get('removing'):
+				removing = m['removing'].get('vcfs') or m['removing'].get('samples')
+				inconsistent_collections.append((m, 'removing [{}]'.format(', '.join(removing))))
 	
 	return bad_meta, bad_tables, inconsistent_collections
 
 
 
-def do_fix(db, collection=None):
+def do_fix(db, collection=None, batch_size=1000, hide_loading=False):
 
 	if collection is None:
 		bad_meta, bad_tables = find_spurious_meta_and_tables(r.table('__METADATA__').run(db), r.table_list().run(db))
@@ -301,6 +465,8 @@ def do_fix(db, collection=None):
 			return 0, 0
 
 		r.table('__METADATA__').get_all(*bad_meta).delete().run(db)
+		for collection in bad_meta:
+			delete_vcfs(db, collection)
 
 		for table in bad_tables:
 			r.table_drop(table).run(db)
@@ -310,12 +476,12 @@ def do_fix(db, collection=None):
 	#else
 	check_collection_name(collection)
 
-	meta = r.table('__METADATA__').get(collection).run(db)
+	meta = upgrade_metadata(db, r.table('__METADATA__').get(collection).run(db))
 
 	if meta is None:
 		raise BadCollection('collection {} does not exist.'.format(collection))
 
-	doing_init = meta.get('doing_init')
+	doing_init = meta.get('doing_init') or meta.get('copying_from')
 	appending_filenames = meta.get('appending_filenames')
 	
 
@@ -327,50 +493,324 @@ def do_fix(db, collection=None):
 		do_delete(db, collection)
 		return 'doing_init'
 
+	if meta.get('removing'):
+		# Removals are idempotent, the fix is to complete them.
+		return 'removing', do_remove(db, collection, batch_size=batch_size, hide_loading=hide_loading, **meta['removing'])
+
 	if appending_filenames:
-		bad_samples = [k for k in meta['samples'] if meta['samples'][k] in appending_filenames]
-		result = r.table(collection) \
-					.filter(r.row['IDs'].keys().set_intersection(appending_filenames) != [])\
-					.replace(lambda x: r.branch(x['IDs'].keys().set_difference(appending_filenames) == [],
+		bad_samples = list(collection_samples(db, collection, appending_filenames))
+		# Files whose metadata was never stored can't have records either.
+		bad_keys = list(collection_file_keys(db, collection, appending_filenames).values())
+		revert = lambda x: r.branch(x['IDs'].keys().set_difference(bad_keys) == [],
 						None, # delete record
 						x.merge({
-							'IDs': r.literal(x['IDs'].without(appending_filenames)),
-							'QUALs': r.literal(x['QUALs'].without(appending_filenames)),
-							'FILTERs': r.literal(x['FILTERs'].without(appending_filenames)),
-							'INFOs': r.literal(x['INFOs'].without(appending_filenames)),
+							'IDs': r.literal(x['IDs'].without(bad_keys)),
+							'QUALs': r.literal(x['QUALs'].without(bad_keys)),
+							'FILTERs': r.literal(x['FILTERs'].without(bad_keys)),
+							'INFOs': r.literal(x['INFOs'].without(bad_keys)),
 							'samples': r.literal(x['samples'].without(bad_samples)),
-							}))).run(db)
+							}).do(lambda reverted: reverted.merge(allele_stats(reverted))))
+
+		if not bad_keys:
+			# The append failed before storing the files, no record was touched.
+			deleted = replaced = 0
+		elif 'VCFS' in r.table(collection).index_list().run(db):
+			deleted, replaced = revert_by_provenance(db, collection, bad_keys, revert, batch_size, hide_loading)
+		else:
+			# Collections created before the VCFS index existed
+			# can only be reverted with a full table scan.
+			result = r.table(collection) \
+						.filter(r.row['IDs'].keys().set_intersection(bad_keys) != [])\
+						.replace(revert).run(db)
+			check_write(result)
+			deleted, replaced = result['deleted'], result['replaced']
 		
+		# Counts are taken again from the tables, they were increased together
+		# with the appending flag but the files might not have been stored.
+		delete_vcfs(db, collection, appending_filenames)
 		r.table('__METADATA__').get(collection)\
 			.replace(lambda x: x.merge({
-				'vcfs': r.literal(x['vcfs'].without(appending_filenames)),
-				'samples': r.literal(x['samples'].without(bad_samples))
-				}).without('appending_filenames')).run(db)
+				'vcfs_count': r.table('__VCFS__').get_all(collection, index='collection').count(),
+				'samples_count': r.table('__SAMPLES__').get_all(collection, index='collection').count(),
+				'schemas': r.table('__VCFS__').get_all(collection, index='collection')['schema'].distinct()
+				}).without('appending_filenames'), non_atomic=True).run(db)
+		if 'stats' in meta:
+			update_stats_totals(db, collection)
 
-		return appending_filenames, bad_samples, result['deleted'], result['replaced']
+		return appending_filenames, bad_samples, deleted, replaced
 
 	return None
 
 
 
-def do_copy(db, source, dest):
+def revert_by_provenance(db, collection, file_keys, revert, batch_size=1000, hide_loading=False):
+	"""Applies `revert` only to the records that contain data from the
+	files with `file_keys`, found through the VCFS index, `batch_size` records
+	at a time. Reverted records drop out of the index so every batch 
+	simply takes the first ones left, which also makes it resumable."""
+	r.table(collection).index_wait('VCFS').run(db)
+	affected = r.table(collection).get_all(*file_keys, index='VCFS')
+
+	total_records = affected.count().run(db)
+	deleted = replaced = 0
+	while True:
+		result = affected.limit(batch_size).replace(revert, durability='soft').run(db)
+		check_write(result)
+		if result['deleted'] + result['replaced'] == 0:
+			break
+		deleted += result['deleted']
+		replaced += result['replaced']
+
+		if not hide_loading:
+			print('\rReverting: {}/{} records'.format(deleted + replaced, total_records), end=' ')
+			sys.stdout.flush()
+
+	r.table(collection).sync().run(db)
+	if not hide_loading:
+		print('')
+	return deleted, replaced
+
+
+
+def do_copy(db, source, dest, batch_size=1000, workers=4, hide_loading=False):
+	"""Copies a collection one primary key range at a time, keeping up to 
+	`workers` insert queries in flight. The last key known to be copied is
+	checkpointed in the destination metadata so that an interrupted copy 
+	can be resumed by calling this function again with the same arguments.
+	Secondary indexes are rebuilt once all records have been copied."""
 	check_collection_name(source)
 	check_collection_name(dest)
+	assert batch_size > 0 and workers > 0, \
+		"Invalid value for --batch-size or --workers."
 
 	table_list = r.table_list().run(db)
-	source_meta = r.table('__METADATA__').get(source).run(db)
+	source_meta = upgrade_metadata(db, r.table('__METADATA__').get(source).run(db))
 	if not (source in table_list and source_meta is not None):
 		raise BadCollection("source collection does not exist.")
-
-	if not (dest not in table_list and r.table('__METADATA__').get(dest).run(db) is None):
+	if source_meta.get('doing_init') or source_meta.get('appending_filenames') or source_meta.get('copying_from') \
+			or source_meta.get('removing'):
+		raise BadCollection("source collection has pending jobs, use the check command to know more.")
+
+	dest_meta = r.table('__METADATA__').get(dest).run(db)
+	if dest_meta is None and dest not in table_list:
+		dest_meta = dict(source_meta, id=dest, copying_from=source)
+		r.table('__METADATA__').insert(dest_meta).run(db)
+		for table in ('__VCFS__', '__SAMPLES__'):
+			r.table(table).insert(r.table(table).get_all(source, index='collection')
+				.merge(lambda x: {'id': [dest, x['id'][1]], 'collection': dest}), conflict='replace').run(db)
+		r.table_create(dest).run(db)
+	elif dest_meta is not None and dest_meta.get('copying_from') == source and dest in table_list:
+		print('Resuming the copy from key {}.'.format(dest_meta.get('copy_last_key')))
+	else:
 		raise BadCollection("destination collection already exists.")
 
-	r.table_create(dest).run(db)
-	result = r.table(dest).insert(r.table(source)).run(db)
-	source_meta['id'] = dest
-	r.table('__METADATA__').insert(source_meta).run(db)
+	## COPY ROWS ##
+	# Every thread needs its own connection.
+	local = threading.local()
+	def insert_chunk(chunk):
+		if not hasattr(local, 'db'):
+			local.db = r.connect(host=db.host, port=db.port, db=db.db)
+		check_write(r.table(dest).insert(chunk, durability='soft', conflict='replace').run(local.db))
+
+	total_records = r.table(source).count().run(db)
+	last_key = dest_meta.get('copy_last_key')
+	copied_records = resumed_records = 0 if last_key is None else r.table(dest).count().run(db)
+
+	pool = ThreadPool(workers)
+	pending = deque()
+	start_time = time.time()
+	while True:
+		chunk = r.table(source).between(r.minval if last_key is None else last_key, r.maxval, left_bound='open') \
+					.order_by(index='id').limit(batch_size).run(db)
+		chunk = list(chunk)
+
+		# Keep at most `workers` inserts in flight and checkpoint 
+		# the last key of every chunk completed in order (get() raises 
+		# FailedWrite before the checkpoint if an insert failed).
+		while pending and (len(pending) >= workers or not chunk or pending[0][1].ready()):
+			key, result = pending.popleft()
+			result.get()
+			r.table('__METADATA__').get(dest).update({'copy_last_key': key}).run(db)
+
+		if not chunk:
+			break
+
+		last_key = chunk[-1]['id']
+		pending.append((last_key, pool.apply_async(insert_chunk, (chunk,))))
+		copied_records += len(chunk)
+
+		if not hide_loading:
+			elapsed = time.time() - start_time
+			print('\rCopying: {}/{} records'.format(copied_records, total_records), end=' ')
+			print('@ {} records/second'.format(int((copied_records - resumed_records)/elapsed) if elapsed else 0), end=' ')
+			sys.stdout.flush()
+
+	pool.close()
+	pool.join()
+
+	r.table(dest).sync().run(db)
+
+	## REBUILD INDEXES ##
+	for index in r.table(source).index_status().run(db):
+		if index['index'] not in r.table(dest).index_list().run(db):
+			r.table(dest).index_create(index['index'], index['function'], multi=index['multi']).run(db)
+	r.table(dest).index_wait().run(db)
+
+	r.table('__METADATA__').get(dest).replace(lambda x: x.without('copying_from', 'copy_last_key')).run(db)
+
+	return r.table(dest).count().run(db)
+
+
+
+def do_index_field(db, collection, field):
+	check_collection_name(collection)
+
+	metadata = upgrade_metadata(db, r.table('__METADATA__').get(collection).run(db))
+	if metadata is None or collection not in r.table_list().run(db):
+		raise BadCollection('collection {} does not exist.'.format(collection))
+	if metadata.get('doing_init') or metadata.get('appending_filenames') or metadata.get('copying_from') or metadata.get('removing'):
+		raise BadCollection('collection {} has pending jobs, use the check command to know more.'.format(collection))
+
+	return create_field_index(db, collection, field)
+
+
+
+def do_remove(db, collection, samples=None, vcfs=None, batch_size=1000, workers=4, hide_loading=False):
+	"""Removes the data of some samples or of some VCF files (and of their
+	samples) from a collection. Only the records holding data from the 
+	files involved are touched, found through the VCFS index and updated 
+	in parallel batches. Records left without files (or, when removing 
+	samples, without samples) are deleted. The metadata is updated and 
+	the privates index files of the collection are rebuilt. The removal 
+	is recorded in the metadata until completed, an interrupted one is
+	completed by the fix command (or by running it again): files and
+	samples whose metadata is already gone were done with.
+	Returns the number of deleted and updated records."""
+	check_collection_name(collection)
+	assert (samples is None) != (vcfs is None), \
+		"Either samples or VCF files must be removed."
+	assert batch_size > 0 and workers > 0, \
+		"Invalid value for --batch-size or --workers."
+
+	metadata = upgrade_metadata(db, r.table('__METADATA__').get(collection).run(db))
+	if metadata is None or collection not in r.table_list().run(db):
+		raise BadCollection('collection {} does not exist.'.format(collection))
+	removal = {'samples': samples} if vcfs is None else {'vcfs': vcfs}
+	if metadata.get('doing_init') or metadata.get('appending_filenames') or metadata.get('copying_from') \
+			or metadata.get('removing', removal) != removal:
+		raise BadCollection('collection {} has pending jobs, use the check command to know more.'.format(collection))
+	if 'VCFS' not in r.table(collection).index_list().run(db):
+		raise BadCollection('collection {} has no VCFS index, import a file in it with vcf_import.py --append to build it.'.format(collection))
+	resuming = metadata.get('removing') == removal
+
+	if vcfs is not None:
+		file_keys = collection_file_keys(db, collection, vcfs)
+		unknown = [vcf for vcf in vcfs if vcf not in file_keys]
+		if unknown and not resuming:
+			raise BadCollection('VCF files not in collection: {}.'.format(', '.join(unknown)))
+		file_keys = list(file_keys.values())
+		samples = list(collection_samples(db, collection, vcfs))
+		update = lambda x: r.branch(x['IDs'].keys().set_difference(file_keys) == [],
+						None, # delete record
+						x.merge({
+							'IDs': r.literal(x['IDs'].without(file_keys)),
+							'QUALs': r.literal(x['QUALs'].without(file_keys)),
+							'FILTERs': r.literal(x['FILTERs'].without(file_keys)),
+							'INFOs': r.literal(x['INFOs'].without(file_keys)),
+							'samples': r.literal(x['samples'].without(samples)),
+							}).do(lambda removed: removed.merge(allele_stats(removed))))
+	else:
+		sample_vcfs = collection_samples(db, collection)
+		unknown = [sample for sample in samples if sample not in sample_vcfs]
+		if unknown and not resuming:
+			raise BadCollection('samples not in collection: {}.'.format(', '.join(unknown)))
+		# The samples of a file are in every record holding data from it.
+		file_keys = list(collection_file_keys(db, collection, set(sample_vcfs[sample] for sample in samples if sample in sample_vcfs)).values())
+		update = lambda x: r.branch(x['samples'].keys().set_difference(samples) == [],
+						None, # delete record
+						x.merge({'samples': r.literal(x['samples'].without(samples))}) \
+							.do(lambda removed: removed.merge(allele_stats(removed))))
+
+	r.table('__METADATA__').get(collection).update({'removing': removal}).run(db)
+	# Records are updated before the metadata goes away: a removal resumed
+	# without file keys left has no record to update.
+	deleted = updated = 0
+	if file_keys:
+		deleted, updated = update_by_provenance(db, collection, file_keys, update, batch_size, workers, hide_loading)
+
+	## METADATA ##
+	if vcfs is not None:
+		delete_vcfs(db, collection, vcfs)
+	else:
+		delete_samples(db, collection, samples)
+	if 'stats' in metadata:
+		update_stats_totals(db, collection)
+
+	## PRIVATES INDEX FILES ##
+	# Indexes in the database follow the records by themselves.
+	from vcf_privates_index import build_from_collection
+	for name, policy in sorted(metadata.get('privates_indexes', {}).items()):
+		if 'file' in policy:
+			if not hide_loading:
+				print('Rebuilding the privates index file {}.'.format(policy['file']))
+			build_from_collection(db, collection, workers, phased=policy['phased'], alleles_only=policy['alleles_only'], 
+				missing=policy['missing']).save(policy['file'])
+
+	# Cleared last, an interruption anywhere above leaves the removal pending.
+	r.table('__METADATA__').get(collection)\
+		.replace(lambda x: x.merge({
+			'vcfs_count': r.table('__VCFS__').get_all(collection, index='collection').count(),
+			'samples_count': r.table('__SAMPLES__').get_all(collection, index='collection').count(),
+			'schemas': r.table('__VCFS__').get_all(collection, index='collection')['schema'].distinct()
+			}).without('removing'), non_atomic=True).run(db)
+
+	return deleted, updated
+
+
+
+def update_by_provenance(db, collection, file_keys, update, batch_size=1000, workers=4, hide_loading=False):
+	"""Replaces with `update` the records that contain data from the files
+	with `file_keys`, found through the VCFS index. Their ids are read 
+	first, then they are replaced `batch_size` at a time by up to `workers`
+	parallel queries. Returns the number of deleted and updated records."""
+	r.table(collection).index_wait('VCFS').run(db)
+	# Records with data from more than one of the files come up once per file.
+	ids = sorted(set(r.table(collection).get_all(*file_keys, index='VCFS')['id'].run(db)))
+
+	# Every thread needs its own connection.
+	local = threading.local()
+	def replace_batch(batch):
+		if not hasattr(local, 'db'):
+			local.db = r.connect(host=db.host, port=db.port, db=db.db)
+		return r.table(collection).get_all(*batch).replace(update, durability='soft').run(local.db)
+
+	pool = ThreadPool(workers)
+	deleted = updated = processed = 0
+	batches = [ids[start:start + batch_size] for start in range(0, len(ids), batch_size)]
+	for batch, result in zip(batches, pool.imap(replace_batch, batches)):
+		check_write(result)
+		deleted += result['deleted']
+		updated += result['replaced']
+		processed += len(batch)
+
+		if not hide_loading:
+			print('\rRemoving: {}/{} records'.format(processed, len(ids)), end=' ')
+			sys.stdout.flush()
+	pool.close()
+	pool.join()
+
+	r.table(collection).sync().run(db)
+	if not hide_loading:
+		print('')
+	return deleted, updated
+
 
-	return result['inserted']
+
+def check_write(result):
+	"""Raises FailedWrite if a write query failed for some documents,
+	RethinkDB only counts them in the result."""
+	if result['errors']:
+		raise FailedWrite('{} documents not written, first error: {}'.format(result['errors'], result.get('first_error')))
 
 
 
@@ -382,11 +822,194 @@ def do_delete(db, collection):
 
 	r.table_drop(collection).run(db)
 	r.table('__METADATA__').get(collection).delete().run(db)
+	delete_vcfs(db, collection)
 	return True
 
 
 
 
+def do_export(db, collection, out_stream, samples=None, region=None, batch_size=1000):
+	"""Streams the records of a collection ordered by CHROM/POS and writes
+	them to `out_stream` as a multi-sample VCF. Records are fetched from the
+	database in batches of `batch_size`, the collection is never loaded 
+	into memory as a whole."""
+	check_collection_name(collection)
+
+	metadata = upgrade_metadata(db, r.table('__METADATA__').get(collection).run(db))
+	if metadata is None or collection not in r.table_list().run(db):
+		raise BadCollection('collection {} does not exist.'.format(collection))
+
+	vcf_entries = collection_vcfs(db, collection)
+	sample_vcfs = collection_samples(db, collection)
+	if samples is None:
+		vcfs = sorted(vcf_entries)
+		samples = sorted(sample_vcfs, key=lambda s: (sample_vcfs[s], s))
+	else:
+		unknown_samples = [s for s in samples if s not in sample_vcfs]
+		if unknown_samples:
+			raise BadCollection('samples not in collection: {}.'.format(', '.join(unknown_samples)))
+		vcfs = sorted(set(sample_vcfs[s] for s in samples))
+
+	if region is not None:
+		region = parse_region(region)
+
+	check_position_index(db, collection)
+
+	## HEADERS ##
+	out_stream.write(export_headers(load_headers(db, [vcf_entries[vcf] for vcf in vcfs]), samples))
+
+	## RECORDS ##
+	cursor = region_query(collection, region) \
+				.pluck('CHROM', 'POS', 'REF', 'IDs', 'QUALs', 'FILTERs', 'INFOs', {'samples': samples}) \
+				.run(db, max_batch_rows=batch_size)
+
+	exported_records = 0
+	file_keys = [file_key(vcf_entries[vcf]) for vcf in vcfs]
+	for document in cursor:
+		line = export_record(document, file_keys, samples)
+		if line is None:
+			continue
+		out_stream.write(line)
+		exported_records += 1
+
+	return exported_records
+
+
+
+def load_headers(db, vcf_entries):
+	"""Returns the headers of some VCF files given their 
+	__VCFS__ entries, resolving the (shared) schemas they reference."""
+	schemas = {}
+	schema_keys = set(entry['schema'] for entry in vcf_entries)
+	if schema_keys:
+		for doc in r.table('__METADATA__').get_all(*[['schema', key] for key in schema_keys]).run(db):
+			schemas[doc['id'][1]] = doc['schema']
+
+	return [dict(schemas[entry['schema']], fileformat=entry['fileformat']) for entry in vcf_entries]
+
+
+
+def export_headers(vcf_headers, samples):
+	"""Rebuilds a single header section from the headers 
+	stored in the collection metadata for each VCF file."""
+	lines = ['##fileformat={}'.format(max(h['fileformat'] for h in vcf_headers) if vcf_headers else 'VCFv4.1')]
+
+	seen_lines = set()
+	for h in vcf_headers:
+		for key in sorted(h['extra']):
+			for value in h['extra'][key]:
+				line = '##{}={}'.format(key, value)
+				if line not in seen_lines:
+					seen_lines.add(line)
+					lines.append(line)
+
+	for section, tag in (('infos', 'INFO'), ('formats', 'FORMAT')):
+		definitions = {}
+		for h in vcf_headers:
+			for ID, definition in h[section].items():
+				definitions.setdefault(ID, definition)
+		for ID in sorted(definitions):
+			Number, Type, Description = definitions[ID]
+			lines.append('##{}=<ID={},Number={},Type={},Description={}>'.format(tag, ID, Number, Type, Description))
+
+	for section, tag in (('filters', 'FILTER'), ('alts', 'ALT')):
+		definitions = {}
+		for h in vcf_headers:
+			for ID, definition in h[section].items():
+				definitions.setdefault(ID, definition)
+		for ID in sorted(definitions):
+			lines.append('##{}=<ID={},Description={}>'.format(tag, ID, definitions[ID][-1]))
+
+	lines.append('\t'.join(['#CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO', 'FORMAT'] + samples))
+	return '\n'.join(lines) + '\n'
+
+
+
+def export_record(document, vcfs, samples):
+	"""Turns a document back into a VCF line. ALT alleles are the ones
+	called in the selected samples, `vcfs` are the keys of the selected
+	VCF files inside the document (see vcf_query.file_key). Returns None
+	if none of them has data at this position."""
+	present_vcfs = [vcf for vcf in vcfs if vcf in document['IDs']]
+	if not present_vcfs:
+		return None
+
+	# ID
+	IDs = []
+	for vcf in present_vcfs:
+		for ID in document['IDs'][vcf].split(';'):
+			if ID != '.' and ID not in IDs:
+				IDs.append(ID)
+
+	# QUAL
+	QUALs = [document['QUALs'][vcf] for vcf in present_vcfs if document['QUALs'][vcf] is not None]
+
+	# FILTER
+	FILTERs = []
+	for vcf in present_vcfs:
+		for FILTER in document['FILTERs'][vcf].split(';'):
+			if FILTER not in FILTERs:
+				FILTERs.append(FILTER)
+	failed_filters = [f for f in FILTERs if f not in ('PASS', '.')]
+
+	# INFO (first file wins on conflicting keys)
+	INFO = {}
+	for vcf in present_vcfs:
+		for key, value in document['INFOs'][vcf].items():
+			INFO.setdefault(key, value)
+
+	# ALT + FORMAT
+	alleles = {document['REF']: 0}
+	ALT = []
+	fieldnames = set()
+	for sample in samples:
+		sample_data = document['samples'].get(sample)
+		if sample_data is None:
+			continue
+		fieldnames.update(sample_data)
+		for allele in sample_data.get('GT', ()):
+			if allele not in '|/.' and allele not in alleles:
+				alleles[allele] = len(alleles)
+				ALT.append(allele)
+	fieldnames.discard('GT')
+	fieldnames = ['GT'] + sorted(fieldnames)
+
+	columns = [
+		document['CHROM'],
+		str(document['POS']),
+		';'.join(IDs) or '.',
+		document['REF'],
+		','.join(ALT) or '.',
+		format_value(max(QUALs)) if QUALs else '.',
+		';'.join(failed_filters) or ('PASS' if 'PASS' in FILTERs else '.'),
+		';'.join(key if value is True else '{}={}'.format(key, format_value(value)) for key, value in sorted(INFO.items())) or '.',
+		':'.join(fieldnames)
+	]
+
+	for sample in samples:
+		sample_data = document['samples'].get(sample, {})
+		values = []
+		for key in fieldnames:
+			if key == 'GT':
+				values.append(''.join(a if a in '|/.' else str(alleles[a]) for a in sample_data.get('GT', '.')))
+			else:
+				values.append(format_value(sample_data.get(key)))
+		columns.append(':'.join(values))
+
+	return '\t'.join(columns) + '\n'
+
+
+
+def format_value(value):
+	if value is None:
+		return '.'
+	if isinstance(value, list):
+		return ','.join(format_value(v) for v in value)
+	if isinstance(value, float):
+		return str(int(value)) if value.is_integer() else repr(value)
+	return str(value)
+
+
 def check_and_select_db(connection, db_name):
 	if not re.match(r'^[a-zA-Z0-9_]+$', db_name):
 		raise BadDatabase('you can only use alphanumeric characters and underscores for the database name')
@@ -413,8 +1036,10 @@ def check_collection_name(collection):
 		raise BadCollection('collection names starting with double underscores are reserved for internal use.')
 
 def find_spurious_meta_and_tables(metadata, table_list):
-	metadata_set = set([x['id'] for x in metadata if type(x['id']) is not list])
-	tables = set(table_list)
+	# Names starting with double underscores are internal tables
+	# (__METADATA__, __VCFS__, ...) and their documents.
+	metadata_set = set([x['id'] for x in metadata if type(x['id']) is not list and not x['id'].startswith('__')])
+	tables = set([t for t in table_list if not t.startswith('__')])
 
 	bad_meta =  metadata_set - tables
 	bad_tables = tables - metadata_set
@@ -0,0 +1,238 @@
+from __future__ import print_function
+import struct, threading, zlib
+from multiprocessing.pool import ThreadPool
+try:
+	import queue
+except ImportError:
+	import Queue as queue
+
+
+# BGZF is plain gzip made of independent members of at most 64KB,
+# each one carrying its own compressed size in a `BC` extra field.
+# Any gzip reader can decompress it, tabix/htslib can seek in it.
+
+## CONSTANTS ##
+# Same input limit used by htslib, leaves room for incompressible data.
+BGZF_BLOCK_SIZE = 0xff00
+
+BGZF_HEADER = b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00'
+
+BGZF_EOF = b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+
+# Threads inflating BGZF blocks in BgzfReader, zlib releases the GIL.
+DECOMPRESSION_THREADS = 4
+
+# Decompressed buffers BgzfReader keeps ready ahead of the parser.
+READ_AHEAD_BUFFERS = 64
+
+# Compressed bytes read at a time from plain gzip files.
+GZIP_CHUNK_SIZE = 1024 * 1024
+###############
+
+
+class BgzfWriter(object):
+	"""Buffers writes and flushes them as BGZF blocks. Usage:
+
+	>>>> out = BgzfWriter(open('export.vcf.gz', 'wb'))
+	>>>> out.write('##fileformat=VCFv4.1\\n')
+	>>>> out.close()
+	"""
+
+	def __init__(self, fileobj, compresslevel=6):
+		self.fileobj = fileobj
+		self.compresslevel = compresslevel
+		self._buffer = []
+		self._buffered = 0
+
+	def write(self, data):
+		if not isinstance(data, bytes):
+			data = data.encode('utf-8')
+		self._buffer.append(data)
+		self._buffered += len(data)
+
+		if self._buffered >= BGZF_BLOCK_SIZE:
+			data = b''.join(self._buffer)
+			full_blocks = len(data) - len(data) % BGZF_BLOCK_SIZE
+			for start in range(0, full_blocks, BGZF_BLOCK_SIZE):
+				self._write_block(data[start:start + BGZF_BLOCK_SIZE])
+			self._buffer = [data[full_blocks:]]
+			self._buffered = len(data) - full_blocks
+
+	def flush(self):
+		if self._buffered:
+			self._write_block(b''.join(self._buffer))
+		self._buffer = []
+		self._buffered = 0
+		self.fileobj.flush()
+
+	def close(self):
+		self.flush()
+		self.fileobj.write(BGZF_EOF)
+		self.fileobj.close()
+
+	def _write_block(self, data):
+		compressor = zlib.compressobj(self.compresslevel, zlib.DEFLATED, -15)
+		compressed = compressor.compress(data) + compressor.flush()
+
+		# BSIZE is the total block size minus one:
+		# header (18 bytes) + payload + CRC32 and ISIZE (8 bytes)
+		self.fileobj.write(BGZF_HEADER)
+		self.fileobj.write(struct.pack('<H', len(compressed) + 25))
+		self.fileobj.write(compressed)
+		self.fileobj.write(struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data)))
+
+
+class BgzfReader(object):
+	"""Decompresses a BGZF (or plain gzip) file ahead of the reader on a
+	background thread. BGZF blocks are inflated in parallel by `threads`
+	workers, plain gzip members one after the other. At most `queue_size`
+	decompressed buffers wait to be read. tell() returns the compressed 
+	bytes consumed so far, for progress reporting. Usage:
+
+	>>>> headers, samples, records = parse_vcf(BgzfReader(open('myvcf.vcf.gz', 'rb')))
+	"""
+
+	def __init__(self, fileobj, threads=DECOMPRESSION_THREADS, queue_size=READ_AHEAD_BUFFERS):
+		self.fileobj = fileobj
+		self.name = getattr(fileobj, 'name', None)
+		self.threads = threads
+		self._queue = queue.Queue(queue_size)
+		self._buffer = b''
+		self._offset = 0
+		self._consumed = 0
+		self._eof = False
+		self._closed = False
+
+		self._thread = threading.Thread(target=self._read_ahead)
+		self._thread.daemon = True
+		self._thread.start()
+
+	def readable(self):
+		return True
+
+	def read(self, size=-1):
+		chunks = []
+		while size < 0 or size > 0:
+			if not self._fill():
+				break
+			end = len(self._buffer) if size < 0 else min(len(self._buffer), self._offset + size)
+			chunks.append(self._buffer[self._offset:end])
+			if size > 0:
+				size -= end - self._offset
+			self._offset = end
+		return b''.join(chunks)
+
+	def readinto(self, b):
+		view = memoryview(b)
+		filled = 0
+		while filled < len(view) and self._fill():
+			size = min(len(view) - filled, len(self._buffer) - self._offset)
+			view[filled:filled + size] = self._buffer[self._offset:self._offset + size]
+			self._offset += size
+			filled += size
+		return filled
+
+	def tell(self):
+		return self._consumed
+
+	def close(self):
+		self._closed = True
+		self.fileobj.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.close()
+
+	def _fill(self):
+		"""Makes sure there's something left in the current buffer, False at the end of the file."""
+		while self._offset == len(self._buffer):
+			if self._eof:
+				return False
+			item = self._queue.get()
+			if item is None:
+				self._eof = True
+			elif isinstance(item, Exception):
+				self._eof = True
+				raise item
+			else:
+				self._buffer, self._consumed = item
+				self._offset = 0
+		return True
+
+	def _put(self, item):
+		# Gives up if the reader closes the file instead of waiting for the queue forever.
+		while not self._closed:
+			try:
+				self._queue.put(item, timeout=0.1)
+				return
+			except queue.Full:
+				pass
+
+	def _read_ahead(self):
+		try:
+			data = self.fileobj.read(len(BGZF_HEADER) + 2)
+			if data.startswith(BGZF_HEADER[:4]) and data[12:14] == b'BC':
+				self._read_bgzf(data)
+			else:
+				self._read_gzip(data)
+			self._put(None)
+		except Exception as e:
+			self._put(e)
+
+	def _read_bgzf(self, data):
+		pool = ThreadPool(self.threads)
+		try:
+			end = 0
+			pending = None
+			while True:
+				# The next batch of blocks is read while the previous one is inflated.
+				blocks, ends = [], []
+				while data and len(blocks) < self.threads * 4:
+					if len(data) < len(BGZF_HEADER) + 2:
+						raise IOError('Truncated BGZF block in {}.'.format(self.name))
+					block_size = struct.unpack('<H', data[16:18])[0] + 1
+					block = data + self.fileobj.read(block_size - len(data))
+					if len(block) < block_size:
+						raise IOError('Truncated BGZF block in {}.'.format(self.name))
+					end += block_size
+					blocks.append(block)
+					ends.append(end)
+					data = self.fileobj.read(len(BGZF_HEADER) + 2)
+
+				if pending is not None:
+					results, pending_ends = pending
+					for buffer, block_end in zip(results.get(), pending_ends):
+						if buffer:
+							self._put((buffer, block_end))
+				if not blocks or self._closed:
+					break
+				pending = (pool.map_async(inflate_bgzf_block, blocks), ends)
+		finally:
+			pool.terminate()
+
+	def _read_gzip(self, data):
+		consumed = 0
+		decompressor = zlib.decompressobj(31)
+		while data and not self._closed:
+			consumed += len(data)
+			buffer = decompressor.decompress(data)
+			# Concatenated members start over with a new decompressor.
+			while decompressor.unused_data:
+				data = decompressor.unused_data
+				decompressor = zlib.decompressobj(31)
+				buffer += decompressor.decompress(data)
+			if buffer:
+				self._put((buffer, consumed))
+			data = self.fileobj.read(GZIP_CHUNK_SIZE)
+
+
+def inflate_bgzf_block(block):
+	"""Decompresses a whole BGZF block (header included) and checks its CRC."""
+	extra_length = struct.unpack('<H', block[10:12])[0]
+	data = zlib.decompress(block[12 + extra_length:-8], -15)
+	crc, size = struct.unpack('<II', block[-8:])
+	if size != len(data) or crc != zlib.crc32(data) & 0xffffffff:
+		raise IOError('Corrupted BGZF block, CRC mismatch.')
+	return data
@@ -0,0 +1,338 @@
+from __future__ import print_function, division
+import hashlib, json, os, re
+from vcf_miniparser import parse_vcf_together
+try:
+	import numpy as np
+except:
+	print('Unable to import the NumPy python module.')
+	print('To install: pip install numpy')
+	print('\n')
+	raise ImportError
+
+
+# Allele codes: 0 is REF, n is the n-th ALT allele of the row.
+MISSING = -1 # '.' allele
+NO_ALLELE = -2 # padding for calls with less alleles than the ploidy
+
+# Rows processed at a time by concordance().
+BLOCK_SIZE = 65536
+
+# Rows first allocated while building, the arrays then grow by half
+# of their size every time they are full.
+INITIAL_ROWS = 1024
+
+
+class GenotypeMatrix(object):
+	"""Column-store of the calls of a set of samples, meant for
+	whole-collection analytics. Usage:
+
+	>>>> matrix = GenotypeMatrix.from_vcf([open('a.vcf'), open('b.vcf')])
+	>>>> matrix.alleles.shape
+	(1337, 42, 2)
+	>>>> matrix.sample_summary()['het']
+	array([ 12, 305, ...])
+	>>>> matrix.save('mycollection.gtm')
+	>>>> matrix = GenotypeMatrix.load('mycollection.gtm') # memory-mapped
+
+	Attributes:
+	`alleles`: int16 array (positions x samples x ploidy) of allele codes.
+	`missing`: bool array (positions x samples), True for missing calls.
+	`CHROMs`: int32 array of indexes into `contigs`, one per position.
+	`POSs`: int64 array of positions.
+	`samples`, `contigs`: lists of names.
+	`variants`: list of [REF, ALT1, ALT2, ...] per position, which
+	gives the meaning of the allele codes of that position."""
+
+	def __init__(self, samples, contigs, CHROMs, POSs, alleles, missing, variants=None, path=None):
+		self.samples = list(samples)
+		self.contigs = list(contigs)
+		self.CHROMs = CHROMs
+		self.POSs = POSs
+		self.alleles = alleles
+		self.missing = missing
+		self._variants = variants
+		self._path = path
+
+	@property
+	def shape(self):
+		return self.missing.shape
+
+	@property
+	def ploidy(self):
+		return self.alleles.shape[2]
+
+	@property
+	def variants(self):
+		# Loaded from disk only when asked for.
+		if self._variants is None:
+			with open(os.path.join(self._path, 'variants.txt')) as f:
+				self._variants = [line.rstrip('\n').split('\t') for line in f]
+		return self._variants
+
+
+	#
+	# BUILDING
+	#
+
+	@classmethod
+	def from_vcf(cls, filestreams, ploidy=2, **parser_options):
+		"""Builds the matrix directly from `parse_vcf_together` output,
+		`parser_options` go to it (eg. sort=True for files whose records 
+		are not in the same order, see parse_records_together())."""
+		headers, samples, records = parse_vcf_together(filestreams, **parser_options)
+		columns = []
+		for i, file_samples in enumerate(samples):
+			columns.extend((i, k) for k in range(len(file_samples)))
+
+		def rows():
+			for multirecord in records:
+				multirecord = list(multirecord)
+				record = multirecord[0][1]
+				variant = [record.REF]
+				calls = {}
+				for i, record in multirecord:
+					codes = [0]
+					for allele in record.ALT:
+						if allele not in variant:
+							variant.append(allele)
+						codes.append(variant.index(allele))
+					for k, sample in enumerate(record.samples):
+						calls[i, k] = [MISSING if x == '.' else codes[int(x)] for x in split_genotype(sample.get('GT'))]
+				yield record.CHROM, record.POS, variant, [calls.get(column) for column in columns]
+
+		return cls.from_rows([s for file_samples in samples for s in file_samples], rows(), ploidy)
+
+	@classmethod
+	def from_collection(cls, db, collection, samples=None, region=None, ploidy=2, batch_size=1000):
+		"""Builds the matrix from the documents of a collection,
+		scanned in genomic order."""
+		from vcf_query import check_position_index, collection_samples, region_query
+
+		if samples is None:
+			samples = sorted(collection_samples(db, collection))
+		check_position_index(db, collection)
+		cursor = region_query(collection, region).pluck('CHROM', 'POS', 'REF', {'samples': {s: ['GT'] for s in samples}}) \
+					.run(db, max_batch_rows=batch_size)
+
+		def rows():
+			for document in cursor:
+				variant = [document['REF']]
+				calls = []
+				for sample in samples:
+					GT = document['samples'].get(sample, {}).get('GT')
+					if GT is None:
+						calls.append(None)
+						continue
+					call = []
+					for allele in GT:
+						if allele in '|/':
+							continue
+						if allele == '.':
+							call.append(MISSING)
+							continue
+						if allele not in variant:
+							variant.append(allele)
+						call.append(variant.index(allele))
+					calls.append(call)
+				yield document['CHROM'], document['POS'], variant, calls
+
+		return cls.from_rows(samples, rows(), ploidy)
+
+	@classmethod
+	def from_rows(cls, samples, rows, ploidy=2):
+		"""Builds the matrix from (CHROM, POS, [REF, ALT...], calls) tuples
+		where calls has one list of allele codes per sample (None if the
+		sample has no data at that position)."""
+		contigs = []
+		contig_ids = {}
+		variants = []
+
+		# Arrays are grown (and finally trimmed) in place, the rows 
+		# are never copied into a second, complete matrix.
+		CHROMs, POSs, alleles = np.empty(0, np.int32), np.empty(0, np.int64), np.empty((0, len(samples), ploidy), np.int16)
+		row = 0
+		for CHROM, POS, variant, calls in rows:
+			if row == len(CHROMs):
+				capacity = max(INITIAL_ROWS, row + row // 2)
+				for array in (CHROMs, POSs, alleles):
+					array.resize((capacity,) + array.shape[1:], refcheck=False)
+				alleles[row:] = NO_ALLELE
+
+			if CHROM not in contig_ids:
+				contig_ids[CHROM] = len(contigs)
+				contigs.append(CHROM)
+			CHROMs[row] = contig_ids[CHROM]
+			POSs[row] = POS
+			for j, call in enumerate(calls):
+				if call is None:
+					alleles[row, j, 0] = MISSING
+					continue
+				if len(call) > ploidy:
+					raise ValueError('Found a call with more than {} alleles at {}:{}.'.format(ploidy, CHROM, POS))
+				alleles[row, j, :len(call)] = call
+			variants.append(variant)
+			row += 1
+
+		for array in (CHROMs, POSs, alleles):
+			array.resize((row,) + array.shape[1:], refcheck=False)
+		missing = ((alleles == MISSING) | (alleles == NO_ALLELE)).all(axis=2)
+
+		return cls(samples, contigs, CHROMs, POSs, alleles, missing, variants)
+
+
+	#
+	# STORAGE
+	#
+
+	def save(self, path):
+		"""Stores the matrix in a directory, as .npy
+		files that can be loaded memory-mapped."""
+		if not os.path.isdir(path):
+			os.makedirs(path)
+		np.save(os.path.join(path, 'alleles.npy'), self.alleles)
+		np.save(os.path.join(path, 'missing.npy'), self.missing)
+		np.save(os.path.join(path, 'CHROMs.npy'), self.CHROMs)
+		np.save(os.path.join(path, 'POSs.npy'), self.POSs)
+		with open(os.path.join(path, 'variants.txt'), 'w') as f:
+			for variant in self.variants:
+				f.write('\t'.join(variant) + '\n')
+		# Written last, marks the matrix as complete.
+		with open(os.path.join(path, 'matrix.json'), 'w') as f:
+			json.dump({'samples': self.samples, 'contigs': self.contigs}, f)
+		self._path = path
+
+	@classmethod
+	def load(cls, path, mmap_mode='r'):
+		with open(os.path.join(path, 'matrix.json')) as f:
+			info = json.load(f)
+		arrays = [np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode)
+					for name in ('CHROMs', 'POSs', 'alleles', 'missing')]
+		return cls(info['samples'], info['contigs'], *arrays, path=path)
+
+	@classmethod
+	def for_collection(cls, db, collection, cache_dir, **options):
+		"""Returns the matrix of a collection from `cache_dir`, building
+		(and caching) it if missing, if the collection has changed since
+		it was built or if it was built with other `options`."""
+		path = os.path.join(cache_dir, '{}.{}.gtm'.format(collection, collection_fingerprint(db, collection, **options)))
+		if os.path.exists(os.path.join(path, 'matrix.json')):
+			return cls.load(path)
+		matrix = cls.from_collection(db, collection, **options)
+		matrix.save(path)
+		return cls.load(path)
+
+
+	#
+	# ANALYTICS
+	#
+
+	def called(self):
+		"""Called alleles, (positions x samples x ploidy) bool."""
+		return self.alleles >= 0
+
+	def genotype_codes(self, unphased=True, rows=slice(None), alleles_only=False):
+		"""One int64 code per call (positions x samples): equal codes mean
+		equal genotypes, -1 means missing. With `unphased` the order
+		of the alleles is ignored (0|1 == 1|0 == 0/1). With `alleles_only`
+		only the set of called alleles matters, whatever the ploidy
+		(0 == 0/0, 0/1 == 0/1/1 == 0/.). `rows` selects a block of positions."""
+		alleles = self.alleles[rows]
+		if unphased or alleles_only:
+			alleles = np.sort(alleles, axis=2)
+		if alleles_only:
+			# Repeated and missing alleles become padding.
+			alleles = alleles.copy()
+			repeated = np.zeros(alleles.shape, dtype=bool)
+			repeated[:, :, 1:] = alleles[:, :, 1:] == alleles[:, :, :-1]
+			alleles[repeated | (alleles == MISSING)] = NO_ALLELE
+			alleles = np.sort(alleles, axis=2)
+		codes = np.zeros(alleles.shape[:2], dtype=np.int64)
+		for i in range(self.ploidy):
+			codes |= (alleles[:, :, i].astype(np.int64) + 2) << (16 * i)
+		codes[self.missing[rows]] = -1
+		return codes
+
+	def allele_counts(self):
+		"""Count of each allele code per position, (positions x alleles)."""
+		max_code = int(self.alleles.max()) if self.alleles.size else 0
+		return np.stack([(self.alleles == code).sum(axis=(1, 2)) for code in range(max_code + 1)], axis=1) \
+				if self.alleles.size else np.zeros((self.shape[0], 1), dtype=np.int64)
+
+	def heterozygous(self):
+		"""(positions x samples) bool, True for calls whose
+		called alleles are not all the same."""
+		called = self.called()
+		first = self.alleles[:, :, :1]
+		return (called & (self.alleles != first)).any(axis=2) & called[:, :, 0]
+
+	def position_summary(self):
+		"""Per-position AC (non-REF alleles), AN (called alleles),
+		AF, missing calls and heterozygous calls."""
+		called = self.called()
+		AN = called.sum(axis=(1, 2))
+		AC = (called & (self.alleles > 0)).sum(axis=(1, 2))
+		return {
+			'AC': AC,
+			'AN': AN,
+			'AF': np.where(AN > 0, AC / np.maximum(AN, 1), np.nan),
+			'missing': self.missing.sum(axis=1),
+			'het': self.heterozygous().sum(axis=1)
+		}
+
+	def sample_summary(self):
+		"""Per-sample called, missing, heterozygous,
+		homozygous REF and homozygous ALT calls."""
+		called = self.called()
+		het = self.heterozygous()
+		hom = ~het & ~self.missing & called.any(axis=2)
+		non_ref = (called & (self.alleles > 0)).any(axis=2)
+		return {
+			'called': (~self.missing).sum(axis=0),
+			'missing': self.missing.sum(axis=0),
+			'missing_rate': self.missing.mean(axis=0) if self.shape[0] else np.zeros(self.shape[1]),
+			'het': het.sum(axis=0),
+			'hom_ref': (hom & ~non_ref).sum(axis=0),
+			'hom_alt': (hom & non_ref).sum(axis=0)
+		}
+
+	def concordance(self, unphased=True, block_size=BLOCK_SIZE):
+		"""Pairwise genotype concordance between samples: a (samples x samples)
+		matrix with the fraction of the positions called in both samples
+		where the two genotypes are equal (NaN if there are none).
+		Computed as a sum of one-hot matrix products, one block of rows
+		at a time."""
+		num_samples = self.shape[1]
+		equal = np.zeros((num_samples, num_samples))
+		both_called = np.zeros((num_samples, num_samples))
+		for start in range(0, self.shape[0], block_size):
+			codes = self.genotype_codes(unphased, slice(start, start + block_size))
+			called = (codes != -1).astype(np.float64)
+			both_called += called.T.dot(called)
+			for code in np.unique(codes[codes != -1]):
+				one_hot = (codes == code).astype(np.float64)
+				equal += one_hot.T.dot(one_hot)
+		with np.errstate(invalid='ignore', divide='ignore'):
+			return equal / both_called
+
+
+
+def split_genotype(GT):
+	"""Returns the alleles of a GT value as parsed from a VCF."""
+	if GT is None:
+		return ['.']
+	if isinstance(GT, list):
+		return GT
+	return re.split(r'[|/]', GT)
+
+def collection_fingerprint(db, collection, **options):
+	"""Changes whenever the VCF files or the samples of a collection do
+	(including their file ids and summary stats, rewritten by every 
+	import, append or removal), and with the from_collection() `options`
+	that change the matrix."""
+	import rethinkdb as r
+	from vcf_query import collection_vcfs
+
+	options.pop('batch_size', None)
+	samples = sorted(r.table('__SAMPLES__').get_all(collection, index='collection').run(db), key=lambda doc: doc['sample'])
+	state = [sorted(collection_vcfs(db, collection).items()), samples, sorted(options.items())]
+	return hashlib.sha1(json.dumps(state, sort_keys=True, default=str).encode('utf-8')).hexdigest()[:12]
@@ -1,8 +1,11 @@
 #!/usr/bin/env python
 
 from __future__ import print_function
-import os, sys, gzip, itertools, re, time, datetime
-from vcf_miniparser import parse_vcf_together
+import os, sys, itertools, re, time, datetime
+from vcf_bgzf import BgzfReader
+from vcf_miniparser import parse_vcf_together, header_schema, schema_hash, INFERENCE_SAMPLE_SIZE, UnsortedFile
+from vcf_query import create_position_index, check_position_index, check_field_indexes, init_metadata_tables, store_vcfs, \
+	upgrade_metadata, allele_stats, store_sample_stats, SAMPLE_STATS
 try:
 	import rethinkdb as r
 except:
@@ -11,6 +14,9 @@ except:
 	print('\n')
 	raise ImportError
 
+# Ti/Tv of the sample stats:
+TRANSITIONS = (set(['A', 'G']), set(['C', 'T']))
+
 # TODO: enable chunked import for append operations
 # TODO: allow concurrent --append operations
 # TODO: fix edge case for quick imports
@@ -53,8 +59,25 @@ def main():
 	parser.add_argument('--ignore-bad-info', action='store_true',
 		help='When specified, info fields that fail to respect their field definition (for example by having a string value inside an `Integer` field) are dropped with a warning. Other INFO fields from the same record are preserved if well formed.')
 
+	parser.add_argument('--normalize', action='store_true',
+		help='Trim alleles to their minimal representation, split multi-allelic records whose alleles fall on different positions and join records of the same file that fall on the same position, so that variants described differently by different callers are stored together.')
+
+	parser.add_argument('--infer-types', default=INFERENCE_SAMPLE_SIZE, type=int,
+		help='How many records of each file are looked at to infer the type of INFO and FORMAT fields that the headers do not define. 0 stores all undefined fields as lists of strings. Defaults to {}.'.format(INFERENCE_SAMPLE_SIZE))
+
+	parser.add_argument('--samples', metavar='list.txt',
+		help='Only load the samples listed in this file (one name per line). The other sample columns are skipped and records where all the selected samples are homozygous reference or missing are not stored.')
+
+	parser.add_argument('--sort', action='store_true',
+		help='Sort the records of every file by CHROM and POS before merging them, spilling sorted runs to temporary files. Files are otherwise expected sorted by POS within each CHROM, with CHROMs in the order of the `##contig` lines (or, for undeclared ones, in the same order in every file). Only needed when importing more than one file.')
+
 	args = parser.parse_args()
 
+	selected_samples = None
+	if args.samples is not None:
+		with open(args.samples) as f:
+			selected_samples = [line.strip() for line in f if line.strip()]
+
 	# Input sanity is delegated to the import functions.
 	# This way you can directly import those and do imports
 	# programatically.
@@ -74,18 +97,32 @@ def main():
 						hide_loading=args.hide_loading, 
 						chunk_size=args.chunk_size, 
 						hard_durability=args.hard_durability,
-						ignore_bad_info=args.ignore_bad_info)
+						ignore_bad_info=args.ignore_bad_info,
+						normalize=args.normalize,
+						infer_types=args.infer_types,
+						selected_samples=selected_samples,
+						sort=args.sort)
 		else:
 			append_load(db_connection, args.collection, args.vcf_filenames, 
 						hide_loading=args.hide_loading, 
 						chunk_size=args.chunk_size, 
 						hard_durability=args.hard_durability,
-						ignore_bad_info=args.ignore_bad_info)
+						ignore_bad_info=args.ignore_bad_info,
+						normalize=args.normalize,
+						infer_types=args.infer_types,
+						selected_samples=selected_samples,
+						sort=args.sort)
 	except ValueError: 
 		# Hide the exception stacktrace from command line output. 
 		# In the case of ValueError explanations have already 
 		# been printed to stdout.
 		exit(1)
+	except UnsortedFile as e:
+		file_index, CHROM, POS, previous_CHROM, previous_POS = e.args
+		print('\nThe records of {} are not in the same CHROM and POS order as the other files: found CHROM: {} POS: {} after CHROM: {} POS: {}, aborting.'.format(
+			args.vcf_filenames[file_index], CHROM, POS, previous_CHROM, previous_POS))
+		print('Use vcf_admin.py to revert the partial import, then import again with `--sort`.')
+		exit(1)
 	stop_time = time.time()
 
 	print('Loaded all records in', int(stop_time - start_time), 'seconds.')
@@ -104,7 +141,8 @@ def check_parameters(collection, vcf_filenames, chunk_size):
 
 
 
-def quick_load(db, collection, vcf_filenames, hide_loading=False, chunk_size=20, hard_durability=False, ignore_bad_info=False):
+def quick_load(db, collection, vcf_filenames, hide_loading=False, chunk_size=20, hard_durability=False, ignore_bad_info=False, normalize=False, 
+	infer_types=INFERENCE_SAMPLE_SIZE, selected_samples=None, sort=False):
 	"""Performs the loading operations for a new collection."""
 
 	# Check parameters:
@@ -121,9 +159,8 @@ def quick_load(db, collection, vcf_filenames, hide_loading=False, chunk_size=20,
 	##########################
 
 	# Load parsers:
-	headers, samples, parsers, filestreams = init_parsers(vcf_filenames, ignore_bad_info=ignore_bad_info)
-	# I want the original filestreams, not the 'fake' ones offered by gzip
-	filestreams = [f.fileobj if f.name.endswith('.gz') else f for f in filestreams]
+	headers, samples, parsers, filestreams = init_parsers(vcf_filenames, ignore_bad_info=ignore_bad_info, normalize=normalize, 
+		infer_types=infer_types, selected_samples=selected_samples, sort=sort)
 
 	# Get filesize for every stream, used to print completion percentage and speed.
 	total_filesize = float(sum([os.path.getsize(vcf) for vcf in vcf_filenames]))
@@ -132,26 +169,36 @@ def quick_load(db, collection, vcf_filenames, hide_loading=False, chunk_size=20,
 	## STORE METADATA ##
 	collection_info = {
 		'id': collection,
-		'vcfs': {vcf_filenames[i] : headers[i]._asdict() for i in range(len(headers))},
-		'samples': {sample: vcf_filenames[i] for i in range(len(headers)) for sample in samples[i]},
+		'vcfs_count': len(vcf_filenames),
+		'samples_count': sum(len(s) for s in samples),
+		'schemas': sorted(set(schema_hash(header_schema(h)) for h in headers)),
+		'stats': dict((key, 0) for key in SAMPLE_STATS),
 		'doing_init': True
 	}
 
 	r.table('__METADATA__').insert(collection_info).run(db)
+	file_keys = store_vcfs(db, collection, vcf_filenames, headers, samples)
 
 	# Create the new table required to store the collection:
 	r.table_create(collection).run(db)
 
+	# Records are found by VCF of origin when reverting failed appends:
+	r.table(collection).index_create('VCFS', r.row['IDs'].keys(), multi=True).run(db)
+
+	# Region scans in genomic order:
+	create_position_index(db, collection)
+
 	
 	## STORE ROWS ##
 	
 	# Timers for completion percentage:
 	last_iter = start_time = time.time()
 
-	chunk = list(merge_records(multirecord, vcf_filenames, samples) for multirecord in itertools.islice(parsers, chunk_size))
+	sample_stats = new_sample_stats(samples)
+	chunk = list(merge_records(multirecord, file_keys, samples, sample_stats) for multirecord in itertools.islice(parsers, chunk_size))
 	while chunk:
 		r.table(collection).insert(chunk, durability=durability).run(db)
-		chunk = list(merge_records(multirecord, vcf_filenames, samples) for multirecord in itertools.islice(parsers, chunk_size))
+		chunk = list(merge_records(multirecord, file_keys, samples, sample_stats) for multirecord in itertools.islice(parsers, chunk_size))
 
 		if not hide_loading:
 			pos = sum([f.tell() for f in filestreams])
@@ -168,10 +215,12 @@ def quick_load(db, collection, vcf_filenames, hide_loading=False, chunk_size=20,
 	# flag insert job as complete once data is written to disk
 	r.table(collection).sync().run(db)
 	print('OK, updating metadata.')
+	store_sample_stats(db, collection, sample_stats)
 	r.table('__METADATA__').get(collection).replace(lambda x: x.without('doing_init')).run(db)
 	
 
-def append_load(db, collection, vcf_filenames, hide_loading=False, chunk_size=20, hard_durability=False, ignore_bad_info=False):
+def append_load(db, collection, vcf_filenames, hide_loading=False, chunk_size=20, hard_durability=False, ignore_bad_info=False, normalize=False, 
+	infer_types=INFERENCE_SAMPLE_SIZE, selected_samples=None, sort=False):
 	"""Performs the loading operations for a collection that already contains samples."""
 	
 	# Check parameters:
@@ -181,7 +230,7 @@ def append_load(db, collection, vcf_filenames, hide_loading=False, chunk_size=20
 	durability = 'hard' if hard_durability else 'soft'
 
 	### CONSISTENCY CHECKS ###
-	metadata = r.table('__METADATA__').get(collection).run(db)
+	metadata = upgrade_metadata(db, r.table('__METADATA__').get(collection).run(db))
 	table_list = r.table_list().run(db)
 
 	assert (collection in table_list) == (metadata is not None), \
@@ -189,31 +238,32 @@ def append_load(db, collection, vcf_filenames, hide_loading=False, chunk_size=20
 
 	if metadata is None:
 		print('This is a new collection, switching to direct loading method.')
-		return quick_load(db, collection, vcf_filenames, hide_loading=hide_loading, chunk_size=chunk_size, hard_durability=hard_durability, ignore_bad_info=ignore_bad_info)
+		return quick_load(db, collection, vcf_filenames, hide_loading=hide_loading, chunk_size=chunk_size, hard_durability=hard_durability, ignore_bad_info=ignore_bad_info, normalize=normalize, infer_types=infer_types,
+			selected_samples=selected_samples, sort=sort)
 	else:
 		# must check if the collection has finished its pending operations
-		assert not metadata.get('doing_init') and not metadata.get('appending_filenames'), \
+		assert not metadata.get('doing_init') and not metadata.get('appending_filenames') and not metadata.get('copying_from') \
+			and not metadata.get('removing'), \
 			"This collection either has still to complete another import operation or has been left in an inconsistent state, aborting. Use vcf_admin to perform consistency checks."
 	#########################
 
 	# Load parsers:
-	headers, samples, parsers, filestreams = init_parsers(vcf_filenames, ignore_bad_info=ignore_bad_info)
-	# I want the original filestreams, not the 'fake' ones offered by gzip
-	filestreams = [f.fileobj if f.name.endswith('.gz') else f for f in filestreams]
+	headers, samples, parsers, filestreams = init_parsers(vcf_filenames, ignore_bad_info=ignore_bad_info, normalize=normalize, 
+		infer_types=infer_types, selected_samples=selected_samples, sort=sort)
 
 
 	# check if there are collisions between new samples and the samples already loaded
 	new_samples = set([sample for sublist in samples for sample in sublist])
-	old_samples = set(metadata['samples'].keys())
-	inter_samples = new_samples & old_samples
+	inter_samples = set(doc['sample'] for doc in 
+		r.table('__SAMPLES__').get_all(*[[collection, sample] for sample in new_samples]).run(db))
 	if inter_samples:
 		print('Some sample names are colliding, aborting.')
 		print('Offending names:', ', '.join(inter_samples))
 		raise ValueError
 
 	# check if there are collisions between VCF filenames
-	old_vcf_filenames = set(metadata['vcfs'].keys())
-	inter_vcf_filenames = set(vcf_filenames) & old_vcf_filenames
+	inter_vcf_filenames = set(doc['vcf'] for doc in 
+		r.table('__VCFS__').get_all(*[[collection, vcf] for vcf in vcf_filenames]).run(db))
 	if inter_vcf_filenames:
 		print('Some VCF filenames are colliding, aborting.')
 		print('Offending names:', ', '.join(inter_vcf_filenames))
@@ -229,26 +279,42 @@ def append_load(db, collection, vcf_filenames, hide_loading=False, chunk_size=20
 
 	## UPDATE METADATA ##
 	collection_info = {
-		'vcfs': {vcf_filenames[i] : headers[i]._asdict() for i in range(len(headers))},
-		'samples': {sample: vcf_filenames[i] for i in range(len(headers)) for sample in samples[i]},
+		'vcfs_count': r.row['vcfs_count'] + len(vcf_filenames),
+		'samples_count': r.row['samples_count'] + len(new_samples),
+		'schemas': r.row['schemas'].set_union([schema_hash(header_schema(h)) for h in headers]),
 		'appending_filenames': vcf_filenames
 	}
 
-	r.table('__METADATA__').get(collection).update(r.row.merge(collection_info)).run(db)
+	# Collections created before the VCFS index existed get it now,
+	# before any record is touched, so that vcf_admin can revert a 
+	# failed append without scanning the whole table.
+	if 'VCFS' not in r.table(collection).index_list().run(db):
+		print('Building the VCFS index, this is done only once.')
+		r.table(collection).index_create('VCFS', r.row['IDs'].keys(), multi=True).run(db)
+		r.table(collection).index_wait('VCFS').run(db)
+	check_position_index(db, collection)
+	check_field_indexes(db, collection, headers)
+
+	r.table('__METADATA__').get(collection).update(collection_info).run(db)
+	file_keys = store_vcfs(db, collection, vcf_filenames, headers, samples)
 
 	## UPDATE ROWS ##
 	# Timers for completion percentage:
 	last_iter = start_time = time.time()
 
 	## UPDATE ROWS ##
+	# Collections imported before the stats existed only get the
+	# per-record ones, per-sample ones would be incomplete.
+	sample_stats = new_sample_stats(samples) if 'stats' in metadata else None
 	for multirecord in parsers:
-		merged_record = merge_records(multirecord, vcf_filenames, samples)
+		merged_record = merge_records(multirecord, file_keys, samples, sample_stats)
 
-		result = r.table(collection).get(merged_record['id']).replace(
-			r.branch(r.row == None, 
+		# AN/AC/AF of existing records are computed again over all their samples.
+		result = r.table(collection).get(merged_record['id']).replace(lambda row:
+			r.branch(row == None, 
 				merged_record, # new record
-				r.branch(r.row['REF'] == merged_record['REF'],
-					r.row.merge(merged_record),
+				r.branch(row['REF'] == merged_record['REF'],
+					row.merge(merged_record).do(lambda merged: merged.merge(allele_stats(merged))),
 					r.error())), durability='soft').run(db)
 		
 		if result['errors']:
@@ -270,6 +336,8 @@ def append_load(db, collection, vcf_filenames, hide_loading=False, chunk_size=20
 	# flag insert job as complete once data is written to disk
 	r.table(collection).sync().run(db)
 	print('OK, updating metadata.')
+	if sample_stats is not None:
+		store_sample_stats(db, collection, sample_stats)
 	r.table('__METADATA__').get(collection).replace(lambda x: x.without('appending_filenames')).run(db)
 
 
@@ -311,30 +379,45 @@ def check_and_init_db(db_connection, db_name):
 	assert metadata is not None and metadata.get('application') == 'vcfthink', \
 		"The database named `{}` does not belong to this application. Use vcf_init.py to initialize a new database.".format(db_name)
 
+	init_metadata_tables(db_connection)
+
 
-def init_parsers(vcf_filenames, ignore_bad_info=False):
-	"""Opens the filestreams and instantiates each corresponding parser."""
+def init_parsers(vcf_filenames, ignore_bad_info=False, normalize=False, infer_types=INFERENCE_SAMPLE_SIZE, selected_samples=None,
+	sort=False):
+	"""Opens the filestreams and instantiates each corresponding parser,
+	optionally only parsing the `selected_samples`."""
 
 	filestreams = []
 	for filename in vcf_filenames:
 		if filename.endswith(".gz"):
-			filestreams.append(gzip.open(filename, 'r'))
+			# Decompressed on background threads, tell() counts compressed bytes.
+			filestreams.append(BgzfReader(open(filename, 'rb')))
 		else:
 			filestreams.append(open(filename, 'r'))
-	headers, samples, parsers = parse_vcf_together(filestreams, ignore_bad_info=ignore_bad_info)
+	headers, samples, parsers = parse_vcf_together(filestreams, ignore_bad_info=ignore_bad_info, normalize=normalize, 
+		infer_types=infer_types, samples=selected_samples, sort=sort)
 	
 	flattened_samples = tuple([sample for sublist in samples for sample in sublist])
 	assert len(flattened_samples) == len(set(flattened_samples)), \
 		"Some sample names are colliding. Check your VCF files, aborting."
 
+	if selected_samples is not None:
+		missing_samples = set(selected_samples) - set(flattened_samples)
+		assert not missing_samples, \
+			"Some of the selected samples are not in any VCF file: {}, aborting.".format(', '.join(sorted(missing_samples)))
+		assert all(samples), \
+			"Some VCF files contain none of the selected samples, aborting."
+
 	return headers, samples, parsers, filestreams
 
 
 
-def merge_records(multirecord, vcf_filenames, sample_names):
+def merge_records(multirecord, file_keys, sample_names, sample_stats=None):
 	"""Performs the merging operations required to store multiple (corresponding) 
 	rows of different VCF files as a single object/document into the DBMS.
-	Basically it's the glue between parsers and DB."""
+	Basically it's the glue between parsers and DB. The data of the i-th
+	file is keyed by `file_keys[i]` (see vcf_query.store_vcfs). The calls
+	are counted in `sample_stats` (see new_sample_stats()), if given."""
 
 	assert all(multirecord[0][1].REF == record.REF for _, record in multirecord ), \
 		"Found mismatched REF for #CHROM: {}, POS: {}, aborting. All samples in the same collection must share the same reference genome.".format(multirecord[0][1].CHROM, multirecord[0][1].POS)
@@ -350,16 +433,32 @@ def merge_records(multirecord, vcf_filenames, sample_names):
 
 	for i, record in multirecord:
 		record.ALT.insert(0, record.REF)
-		for sample in record.samples:
-			if 'GT' in sample:
-				alleles = re.split(r'([|/])', sample['GT'])
-				sample['GT'] = list(x if x in "|/." else record.ALT[int(x)] for x in alleles)
+		for k, sample in enumerate(record.samples):
+			# Parsed samples are read-only, documents get plain dicts.
+			sample_data = dict(sample)
+			if 'GT' in sample_data:
+				alleles = re.split(r'([|/])', sample_data['GT'])
+				sample_data['GT'] = list(x if x in "|/." else record.ALT[int(x)] for x in alleles)
+			samples[sample_names[i][k]] = sample_data
 			
-		IDs[vcf_filenames[i]] = record.ID
-		QUALs[vcf_filenames[i]] = record.QUAL
-		FILTERs[vcf_filenames[i]] = record.FILTER
-		INFOs[vcf_filenames[i]] = record.INFO
-		samples.update([(sample_names[i][k], sample_data) for (k, sample_data) in enumerate(record.samples)])
+		IDs[file_keys[i]] = record.ID
+		QUALs[file_keys[i]] = record.QUAL
+		FILTERs[file_keys[i]] = record.FILTER
+		INFOs[file_keys[i]] = record.INFO
+
+	# Same as vcf_query.allele_stats()
+	AN = 0
+	AC = {}
+	for sample_data in samples.values():
+		for allele in sample_data.get('GT', ()):
+			if allele not in '|/.':
+				AN += 1
+				if allele != REF:
+					AC[allele] = AC.get(allele, 0) + 1
+
+	if sample_stats is not None:
+		for sample, sample_data in samples.items():
+			count_call(sample_stats[sample], sample_data.get('GT'), REF)
 
 	return {
 		'id': '-'.join([CHROM, str(POS)]),
@@ -370,11 +469,44 @@ def merge_records(multirecord, vcf_filenames, sample_names):
 		'QUALs': QUALs,
 		'FILTERs': FILTERs,
 		'INFOs': INFOs,
-		'samples': samples
+		'samples': samples,
+		'AN': AN,
+		'AC': AC,
+		'AF': dict((allele, count/float(AN)) for allele, count in AC.items())
 	}
 
 
 
+def new_sample_stats(sample_names):
+	return dict((sample, dict((key, 0) for key in SAMPLE_STATS)) for names in sample_names for sample in names)
+
+
+
+def count_call(stats, GT, REF):
+	"""Adds a call (a GT as stored, eg: ['A', '/', 'C']) to the stats of a sample."""
+	if not GT:
+		stats['missing'] += 1
+		return
+	alleles = [allele for allele in GT if allele not in '|/']
+	if '.' in alleles:
+		stats['missing'] += 1
+	elif all(allele == REF for allele in alleles):
+		stats['hom_ref'] += 1
+	elif len(set(alleles)) == 1:
+		stats['hom_alt'] += 1
+	else:
+		stats['het'] += 1
+
+	if len(REF) == 1:
+		for allele in set(alleles):
+			if len(allele) == 1 and allele not in (REF, '.'):
+				if set([REF, allele]) in TRANSITIONS:
+					stats['transitions'] += 1
+				else:
+					stats['transversions'] += 1
+
+
+
 
 if __name__ == '__main__':
 	main()
@@ -1,14 +1,137 @@
 from __future__ import print_function
-from collections import namedtuple
+from collections import namedtuple, defaultdict
+import codecs, hashlib, heapq, itertools, json, re, tempfile
+try:
+	import cPickle as pickle
+except ImportError:
+	import pickle
+try:
+	from collections.abc import Mapping
+except ImportError:
+	from collections import Mapping
 
 
-# TODO: remove state from module
 # TODO: better error control
 
 
 ## DATA STRUCTURES ##
-Record = namedtuple("Record", "CHROM POS ID REF ALT QUAL FILTER INFO samples")
 Headers = namedtuple("Headers", "fileformat infos formats filters alts extra")
+
+class Record(object):
+	"""A parsed record, same fields (and _replace()) as a namedtuple 
+	without the per-instance overhead. `samples` is a list of Sample 
+	(plain dicts for records rebuilt by normalize_records())."""
+	__slots__ = ('CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO', 'samples')
+	_fields = __slots__
+
+	def __init__(self, CHROM, POS, ID, REF, ALT, QUAL, FILTER, INFO, samples):
+		self.CHROM = CHROM
+		self.POS = POS
+		self.ID = ID
+		self.REF = REF
+		self.ALT = ALT
+		self.QUAL = QUAL
+		self.FILTER = FILTER
+		self.INFO = INFO
+		self.samples = samples
+
+	def _replace(self, **fields):
+		values = dict((name, getattr(self, name)) for name in self._fields)
+		values.update(fields)
+		return Record(**values)
+
+	def __eq__(self, other):
+		return isinstance(other, Record) and all(getattr(self, name) == getattr(other, name) for name in self._fields)
+
+	def __ne__(self, other):
+		return not self == other
+
+	__hash__ = None
+
+	def __repr__(self):
+		return 'Record({})'.format(', '.join('{}={!r}'.format(name, getattr(self, name)) for name in self._fields))
+
+
+class SampleFormat(object):
+	"""The FORMAT keys of a record with their converters, shared by all 
+	its samples and by all the records of a file with the same FORMAT."""
+	__slots__ = ('keys', 'positions', 'converters')
+
+	def __init__(self, keys, converters=None):
+		self.keys = tuple(keys)
+		self.positions = dict((key, i) for i, key in enumerate(self.keys))
+		self.converters = converters
+
+	def __reduce__(self):
+		# Converters are only needed while parsing.
+		return SampleFormat, (self.keys,)
+
+
+class Sample(object):
+	"""The values of a sample as a read-only mapping FORMAT key -> value.
+	Only the values are stored per sample, keys come from the shared 
+	SampleFormat. Use to_dict() (or dict()) for a plain, mutable copy.
+	Not a Mapping subclass, which has no __slots__ on Python 2, only 
+	registered as one."""
+	__slots__ = ('_format', '_values')
+
+	def __init__(self, sample_format, values):
+		self._format = sample_format
+		self._values = values
+
+	def __getitem__(self, key):
+		i = self._format.positions[key]
+		if i >= len(self._values):
+			# Trailing fields can be dropped.
+			raise KeyError(key)
+		return self._values[i]
+
+	def get(self, key, default=None):
+		i = self._format.positions.get(key, len(self._values))
+		return self._values[i] if i < len(self._values) else default
+
+	def __contains__(self, key):
+		return self._format.positions.get(key, len(self._values)) < len(self._values)
+
+	def __iter__(self):
+		return iter(self._format.keys[:len(self._values)])
+
+	def __len__(self):
+		return len(self._values)
+
+	def keys(self):
+		return list(self)
+
+	def values(self):
+		return list(self._values)
+
+	def items(self):
+		return list(zip(self._format.keys, self._values))
+
+	def __eq__(self, other):
+		if isinstance(other, Sample):
+			return self.items() == other.items()
+		return isinstance(other, Mapping) and self.to_dict() == dict(other.items())
+
+	def __ne__(self, other):
+		return not self == other
+
+	__hash__ = None
+
+	def to_dict(self):
+		return dict(zip(self._format.keys, self._values))
+
+	def __repr__(self):
+		return repr(self.to_dict())
+
+	def __reduce__(self):
+		return Sample, (self._format, self._values)
+
+Mapping.register(Sample)
+
+
+GT_FORMAT = SampleFormat(['GT'])
+EMPTY_FORMAT = SampleFormat([])
 #####################
 
 
@@ -19,15 +142,27 @@ class BadField(Exception):
 	pass
 class BadInfoField(Exception):
 	pass
+class UnsortedFile(Exception):
+	pass
 ################
 
 # Unsafe typecasting might lead to unwanted behaviours that could 
-# be difficult to debug for the common user, for this reason all 
-# undefined formats are interpreted as variable-length ('.') lists 
-# of strings. 
+# be difficult to debug for the common user, for this reason undefined
+# fields get a definition inferred from the first records of the file
+# (see infer_field_types()) and values that later turn out not to fit
+# it are kept as variable-length ('.') lists of strings, same as the
+# fields first seen after the sampled records.
+
+# Records sampled to infer the types of undefined fields.
+INFERENCE_SAMPLE_SIZE = 1000
+
+INFERRED_DESCRIPTION = '"### FIELD WAS NOT DEFINED, TYPE INFERRED ###"'
+
+# Bytes read at a time from each file by LineReader.
+READ_BUFFER_SIZE = 4 * 1024 * 1024
 
-inferred_infos = {}
-inferred_formats = {}
+# Records kept in memory by sort_records() before spilling a sorted run.
+SORT_RUN_SIZE = 100000
 
 
 standard_info_fields = {}
@@ -53,11 +188,22 @@ standard_format_fields = {}
 # VCF
 #
 
-def parse_vcf(filestream, ignore_bad_info=False, drop_bad_records=False):
+def parse_vcf(filestream, ignore_bad_info=False, drop_bad_records=False, normalize=False, genotypes_only=False, 
+	infer_types=INFERENCE_SAMPLE_SIZE, buffer_size=READ_BUFFER_SIZE, samples=None):
 	"""Immediately parses the headers, the sample names and returns
 	them along with a generator to parse the records. You can optionally
 	silently drop bad records, only drop bad info fields or skip the 
-	checking (and parsing) of custom fields altogether. Usage:
+	checking (and parsing) of custom fields altogether. With `normalize`
+	records go through normalize_records() before being returned. With
+	`genotypes_only` INFO is left empty and samples only carry GT, which
+	is much faster when only the calls are needed. The types of fields
+	not defined in the headers are inferred from the first `infer_types`
+	records (0 disables it) and added to the returned headers. Binary 
+	streams (e.g. gzip.open(path, 'rb')) are read `buffer_size` bytes at
+	a time through a LineReader, 0 reads them line by line. If `samples`
+	is given only those samples are parsed and returned, the other columns 
+	are not even split, and records where all of them are homozygous 
+	reference or missing are dropped. Usage:
 
 	>>>> headers, samples, records = parse_vcf(open('myvcf.vcf', 'r'))
 	>>>> headers
@@ -72,8 +218,105 @@ def parse_vcf(filestream, ignore_bad_info=False, drop_bad_records=False):
 	>>> first_record.samples
 	[{'GT': '0|0', 'GQ': 35, 'DP': 4}, ...]"""
 
-	headers, samples = parse_headers(filestream)
-	return headers, samples, parse_records(filestream, headers, ignore_bad_info, drop_bad_records)
+	if buffer_size and is_binary(filestream):
+		filestream = LineReader(filestream, buffer_size)
+	headers, file_samples = parse_headers(filestream)
+	columns = None
+	if samples is not None:
+		columns = select_columns(file_samples, samples)
+		file_samples = [file_samples[i] for i in columns]
+	lines = filestream
+	if infer_types and not genotypes_only:
+		lines = infer_field_types(filestream, headers, infer_types)
+	records = parse_records(lines, headers, ignore_bad_info, drop_bad_records, genotypes_only, columns)
+	if normalize:
+		records = normalize_records(records, headers)
+	return headers, file_samples, records
+
+
+
+#
+# READING
+#
+
+class LineReader(object):
+	"""Reads the lines of a stream in bulk: `buffer_size` bytes at a time
+	go into a reused bytearray (through readinto() for binary streams, 
+	plain or gzipped), each buffer is decoded with a single call and split 
+	in lines at once. Much cheaper than asking the stream for one line
+	at a time. Offers readline() for the headers and iteration for the
+	records. Lines are returned without their line terminator."""
+
+	def __init__(self, filestream, buffer_size=READ_BUFFER_SIZE):
+		self.filestream = filestream
+		self.buffer_size = buffer_size
+		self._buffer = None
+		self._decoder = codecs.getincrementaldecoder('utf-8')()
+		self._lines = []
+		self._next_line = 0
+		self._rest = ''
+		self._eof = False
+		self._iterator = None
+
+	def __iter__(self):
+		# A single iterator, so the lines it took are never read twice.
+		if self._iterator is None:
+			self._iterator = self._iterate()
+		return self._iterator
+
+	def _iterate(self):
+		while True:
+			# Lines are handed out a whole buffer at a time.
+			lines = self._lines[self._next_line:]
+			self._next_line = len(self._lines)
+			for line in lines:
+				yield line
+			if self._eof:
+				return
+			self._fill()
+
+	def readline(self):
+		while self._next_line == len(self._lines):
+			if self._eof:
+				return ''
+			self._fill()
+		line = self._lines[self._next_line]
+		self._next_line += 1
+		return line
+
+	def close(self):
+		self.filestream.close()
+
+	def _fill(self):
+		if is_binary(self.filestream):
+			if self._buffer is None:
+				self._buffer = bytearray(self.buffer_size)
+			size = self.filestream.readinto(self._buffer)
+			data = memoryview(self._buffer)[:size]
+		else:
+			data = self.filestream.read(self.buffer_size)
+			size = len(data)
+
+		# Python 2 `str` streams are used as they are.
+		if not isinstance(data, str):
+			data = self._decoder.decode(data) if size else self._decoder.decode(b'', True)
+
+		self._lines = (self._rest + data).split('\n')
+		self._next_line = 0
+		if size:
+			self._rest = self._lines.pop()
+		else:
+			# Last line without a terminator, if any.
+			self._eof = True
+			if self._lines == ['']:
+				self._lines = []
+			self._rest = ''
+
+
+def is_binary(filestream):
+	"""Text streams are already buffered and decoded in C by the io module,
+	LineReader only pays off on streams returning bytes."""
+	return hasattr(filestream, 'readinto') and not hasattr(filestream, 'encoding')
 
 
 
@@ -123,154 +366,189 @@ def parse_headers(filestream):
 
 
 def parse_header_line(line, headers):
-	if line.startswith("##INFO"):
-
-		# 0              -
-		# 0123456789 ... 1
-		# ##INFO=<ID ... >
-		ID = Number = Type = Description = None
-
-		subline = line.strip()[8:-1]
-		idkv, numkv, typekv, desckv = subline.split(',', 3) # dirty hack :3
-		# ^ all fields must be present, its fine to fail if there is a mismatch
-
-		# ID
-		key, value = idkv.split('=')
-		assert key == 'ID'
-		ID = value
-
-		# Number
-		key, value = numkv.split('=')
-		assert key == 'Number'
-		Number = value
-
-		# Type
-		key, value = typekv.split('=')
-		assert key == 'Type'
-		Type = value
-
-		# Description
-		key, value = desckv.split('=', 1)
-		assert key == 'Description'
-		Description = value
-
-		headers.infos[ID] = [Number, Type, Description]
+	"""Parses a single `##` header line into `headers`. INFO, FORMAT, 
+	FILTER and ALT definitions are split into their attributes (in any
+	order), all other lines are kept verbatim in `headers.extra`."""
+
+	#  0         1
+	#  0123456789012345 ...
+	#  ##INFO=<ID=DP,Number=1,Type=Integer,Description="...">
+	key, _, value = line.strip()[2:].partition('=')
+
+	if key in ('INFO', 'FORMAT', 'FILTER', 'ALT'):
+		assert value.startswith('<') and value.endswith('>')
+		attributes = parse_header_attributes(value[1:-1])
+		ID = attributes['ID']
+		Description = attributes.get('Description', '""')
+
+		if key == 'INFO':
+			headers.infos[ID] = [attributes['Number'], attributes['Type'], Description]
+		elif key == 'FORMAT':
+			headers.formats[ID] = [attributes['Number'], attributes['Type'], Description]
+		elif key == 'FILTER':
+			headers.filters[ID] = [Description]
+		else:
+			headers.alts[ID] = [Description]
 		return
 
+	if key != 'fileformat':
+		headers.extra.setdefault(key, []).append(value)
 
-	if line.startswith("##FORMAT"):
-
-		# 0         1      -
-		# 012345678901 ... 1
-		# ##FORMAT=<ID ... >
-		ID = Number = Type = Description = None
-
-		subline = line.strip()[10:-1]
-		idkv, numkv, typekv, desckv = subline.split(',', 3)
-		# ^ all fields must be present, its fine to fail if there is a mismatch
-		
-		# ID
-		key, value = idkv.split('=')
-		assert key == 'ID'
-		ID = value
-
-		# Number
-		key, value = numkv.split('=')
-		assert key == 'Number'
-		Number = value
-
-		# Type
-		key, value = typekv.split('=')
-		assert key == 'Type'
-		Type = value
-
-		# Description
-		key, value = desckv.split('=', 1)
-		assert key == 'Description'
-		Description = value
-
-		headers.formats[ID] = [Number, Type, Description]
-		return
 
 
-	if line.startswith("##FILTER"):
+def parse_header_attributes(text):
+	"""Tokenizes the `key=value` pairs of a structured header line (the
+	part between `<` and `>`) in whatever order they appear. Quoted values 
+	can contain commas, equal signs and escaped quotes, and are returned 
+	with their quotes. Usage:
 
-		# 0         1      -
-		# 012345678901 ... 1
-		# ##FILTER=<ID ... >
-		ID = Number = Description = None
+	>>>> parse_header_attributes('ID=DP,Description="Depth, total",Number=1,Type=Integer')
+	{'ID': 'DP', 'Description': '"Depth, total"', 'Number': '1', 'Type': 'Integer'}"""
 
-		subline = line.strip()[10:-1]
-		idkv, numkv, desckv = subline.split(',', 1)
-		# ^ all fields must be present, its fine to fail if there is a mismatch
+	attributes = {}
+	i = 0
+	while i < len(text):
+		equals = text.index('=', i)
+		key = text[i:equals].strip()
+		i = equals + 1
 
-		# ID
-		key, value = idkv.split('=')
-		assert key == 'ID'
-		ID = value
+		if text[i:i+1] == '"':
+			j = i + 1
+			while text[j] != '"':
+				j += 2 if text[j] == '\\' else 1
+			j += 1
+		else:
+			j = text.find(',', i)
+			if j == -1:
+				j = len(text)
 
-		# Number
-		key, value = numkv.split('=')
-		assert key == 'Number'
-		Number = value
+		attributes[key] = text[i:j]
+		i = j + 1
 
-		# Description
-		key, value = desckv.split('=', 1)
-		assert key == 'Description'
-		Description = value
-
-		headers.filters[ID] = [Number, Description]
-		return
+	return attributes
 
 
-	if line.startswith("##ALT"):
 
-		# 0         1     -
-		# 01234567890 ... 1
-		# ##ALT=<ID=D ... >
-		ID = Number = Description = None
-
-		subline = line.strip()[10:-1]
-		idkv, numkv, desckv = subline.split(',', 1)
-		# ^ all fields must be present, its fine to fail if there is a mismatch
-
-		# ID
-		key, value = idkv.split('=')
-		assert key == 'ID'
-		ID = value
-
-		# Number
-		key, value = numkv.split('=')
-		assert key == 'Number'
-		Number = value
+#
+# HEADER SCHEMAS
+#
 
-		# Description
-		key, value = desckv.split('=', 1)
-		assert key == 'Description'
-		Description = value
+# Files produced by the same pipeline share the same header
+# definitions: converter tables are compiled once per set of INFO and
+# FORMAT definitions, for the life of the process (only the schemas
+# are stored in the database, converters are compiled again by every
+# import). Schema hashes cover the whole schema, `##` lines included,
+# since the stored schemas are used to write the headers back.
+compiled_schemas = {}
+
+def header_schema(headers):
+	"""Returns the field definitions of a VCF as a plain dict,
+	ie: the headers without the file format version."""
+	return {
+		'infos': headers.infos,
+		'formats': headers.formats,
+		'filters': headers.filters,
+		'alts': headers.alts,
+		'extra': headers.extra
+	}
+
+def schema_hash(schema):
+	return hashlib.sha1(json.dumps(schema, sort_keys=True).encode('utf-8')).hexdigest()
+
+def header_converters(headers):
+	"""Returns the INFO and FORMAT converter tables for `headers`: a dict
+	field ID -> conversion function for each of them. Standard fields take 
+	precedence over the definitions found in the headers."""
+	key = schema_hash({'infos': headers.infos, 'formats': headers.formats})
+	converters = compiled_schemas.get(key)
+	if converters is None:
+		info_converters = dict((ID, compile_field_converter(d)) for ID, d in headers.infos.items())
+		info_converters.update((ID, compile_field_converter(d)) for ID, d in standard_info_fields.items())
+		format_converters = dict((ID, compile_field_converter(d)) for ID, d in headers.formats.items())
+		format_converters.update((ID, compile_field_converter(d)) for ID, d in standard_format_fields.items())
+		converters = compiled_schemas[key] = (info_converters, format_converters)
+	return converters
 
-		headers.alts[ID] = [Number, Description]
-		return
 
 
 #
 # RECORDS
 #
 
-def parse_records(filestream, headers, ignore_bad_info=False, drop_bad_records=False):
+def parse_records(filestream, headers, ignore_bad_info=False, drop_bad_records=False, genotypes_only=False, columns=None):
+	"""Parses the record lines. With `columns` (see select_columns()) only 
+	those sample columns are parsed and records without a single non
+	reference call among them are skipped."""
+	state = ParserState()
+	info_converters, format_converters = state.converters(headers)
 	for line in filestream:
 		try:
-			yield parse_record_line(line, headers, ignore_bad_info)
+			if genotypes_only:
+				record = parse_genotypes_line(line, columns)
+			else:
+				record = parse_record_line(line, info_converters, format_converters, ignore_bad_info, state, columns)
 		except ValueError:
 			if drop_bad_records:
 				continue
 			#else
 			raise BadRecord(line)
 
+		if columns is not None and not has_variant_calls(record.samples):
+			continue
+		yield record
+
+	state.warn_undefined_fields()
+
+
+
+def select_columns(file_samples, selected_samples):
+	"""Returns the indexes (among the sample columns of a file, in file
+	order) of the samples in `selected_samples`."""
+	selected_samples = set(selected_samples)
+	return [i for i, sample in enumerate(file_samples) if sample in selected_samples]
+
+
+
+def split_record_line(line, columns=None):
+	"""Splits a record line, returns all its fields and the sample columns
+	in `columns` (all of them by default). The columns after the last 
+	selected one are left joined, wide files are never split entirely."""
+	line = line.rstrip('\r\n')
+	if columns is None:
+		fields = line.split('\t')
+		return fields, fields[9:]
+	#else
+	fields = line.split('\t', 10 + columns[-1] if columns else 9)
+	return fields, [fields[9 + i] for i in columns]
+
 
 
-def parse_record_line(line, headers, ignore_bad_info):
-	fields = line.split('\t')
+def has_variant_calls(samples):
+	"""False if the GT of every sample is made only of reference or 
+	missing alleles. Samples without a GT can't be told apart, they 
+	count as variant. GTs declared in the headers as String come as
+	lists of values:
+
+	>>> has_variant_calls([{'GT': '0|0'}, {'GT': ['.']}])
+	False
+	>>> has_variant_calls([{'GT': ['.']}, {'GT': ['1']}])
+	True
+	"""
+	for sample in samples:
+		GT = sample.get('GT')
+		if GT is None:
+			return True
+		if isinstance(GT, list):
+			GT = '/'.join(GT)
+		for allele in GT.replace('|', '/').split('/'):
+			if allele != '0' and allele != '.':
+				return True
+	return False
+
+
+
+def parse_record_line(line, info_converters, format_converters, ignore_bad_info, state, columns=None):
+	fields, sample_fields = split_record_line(line, columns)
 
 	return Record(  
 					CHROM=fields[0],
@@ -280,13 +558,35 @@ def parse_record_line(line, headers, ignore_bad_info):
 					ALT=fields[4].split(','), 
 					QUAL=float(fields[5]),
 					FILTER=fields[6], 
-					INFO=parse_info_field(fields[7], headers.infos, ignore_bad_info),
-					samples=parse_genotype_fields(fields[8], fields[9:], headers.formats)
+					INFO=parse_info_field(fields[7], info_converters, ignore_bad_info, state),
+					samples=parse_genotype_fields(fields[8], sample_fields, format_converters, state)
 				)
 
 
-bad_info_fields = {}
-def parse_info_field(field, header_infos, ignore_bad_info):
+def parse_genotypes_line(line, columns=None):
+	"""GT-only projection of parse_record_line(): only the GT 
+	subfield of each sample is split out, INFO is not parsed."""
+	fields, sample_fields = split_record_line(line, columns)
+
+	if fields[8].startswith('GT'):
+		samples = [Sample(GT_FORMAT, (sample.split(':', 1)[0],)) for sample in sample_fields]
+	else:
+		samples = [Sample(EMPTY_FORMAT, ()) for _ in sample_fields]
+
+	return Record(  
+					CHROM=fields[0],
+					POS=int(fields[1]), 
+					ID=fields[2], 
+					REF=fields[3], 
+					ALT=fields[4].split(','), 
+					QUAL=float(fields[5]),
+					FILTER=fields[6], 
+					INFO={},
+					samples=samples
+				)
+
+
+def parse_info_field(field, info_converters, ignore_bad_info, state):
 	parsed_fields = {}
 
 	if field == '.':
@@ -295,58 +595,43 @@ def parse_info_field(field, header_infos, ignore_bad_info):
 	for kv in field.split(';'):
 
 		try:
-			key, value = kv.split('=')
+			key, value = kv.split('=', 1)
 		except ValueError:
 			# It's a Flag value
 			parsed_fields[kv] = True
 			continue
 
 
-		# Is it a standard field?
-		field_definition = standard_info_fields.get(key, None)
-		if field_definition is not None:
-			try:
-				parsed_value = parse_defined_field(value, field_definition)
-				parsed_fields[key] = parsed_value
-			except ValueError:
-				if ignore_bad_info:
-					if key not in bad_info_fields:
-						bad_info_fields[key] = True
-						print('Warning: field `{}` does not respect its type, dropping it. This is to prevent inconsistent results from queries. Will not notify ulterior errors with the same field ID.'.format(kv))
-					continue
-				raise BadInfoField(kv)
-
-		# Is it defined in the headers?
-		field_definition = header_infos.get(key, None)
-		if field_definition is not None:
+		# Is it a standard field or is it defined in the headers?
+		converter = info_converters.get(key, None)
+		if converter is not None:
 			try:
-				parsed_value = parse_defined_field(value, field_definition)
-				parsed_fields[key] = parsed_value
+				parsed_fields[key] = converter(value)
 			except ValueError:
 				if ignore_bad_info:
-					if key not in bad_info_fields:
-						bad_info_fields[key] = True
+					if key not in state.bad_info_fields:
+						state.bad_info_fields.add(key)
 						print('Warning: field `{}` does not respect its type, dropping it. This is to prevent inconsistent results from queries. Will not notify ulterior errors with the same field ID.'.format(kv))
 					continue
 				raise BadInfoField(kv)
+			continue
 
 		# Undefined field
-		if key not in inferred_infos:
-			inferred_infos[key] = ['.', 'String', '"### FIELD WAS NOT DEFINED ###"']
-
+		state.undefined_infos.add(key)
 		parsed_fields[key] = value.split(',')
 
 
 	return parsed_fields
 
-def parse_genotype_fields(format_field, samples, header_formats):
+def parse_genotype_fields(format_field, samples, format_converters, state):
 
-	fieldnames = format_field.split(':')
-	num_fields = len(fieldnames)
+	sample_format = state.sample_format(format_field, format_converters)
+	num_fields = len(sample_format.keys)
 	if num_fields == 0: 
 		return []	
 
-	first_field_is_GT = int(fieldnames[0] == 'GT')
+	first_field_is_GT = int(sample_format.keys[0] == 'GT')
+	converters = sample_format.converters
 
 	parsed_samples = []
 	for sample in samples:		
@@ -355,75 +640,365 @@ def parse_genotype_fields(format_field, samples, header_formats):
 		# field must be 'GT' and must be present for each sample."
 		assert first_field_is_GT <= len(values) <= num_fields
 		
-		parsed_fields = {}
-		for i in range(len(values)):
-			key = fieldnames[i]
-
-			# First check if this is a standard field:
-			field_definition = standard_format_fields.get(key, None)
-			if field_definition is not None: # hit!
-				parsed_value = parse_defined_field(values[i], field_definition)
-				parsed_fields[key] = parsed_value
-				continue
+		parsed_samples.append(Sample(sample_format, tuple([converters[i](value) for i, value in enumerate(values)])))
 
-			# This is not a standard field, try headers:
-			field_definition = header_formats.get(key, None)
-			if field_definition is not None: #hit!
-				parsed_value = parse_defined_field(values[i], field_definition)
-				parsed_fields[key] = parsed_value
-				continue
-
-			if key not in inferred_formats:
-				inferred_formats[key] = ['.', 'String', '"### FIELD WAS NOT DEFINED ###"']
-
-			parsed_fields[key] = values[i].split(',')
+	return parsed_samples
 
-			# # Field format is unknown, check if we have already seen it:
-			# field_definition = inferred_formats.get(key, None)
-			# if field_definition is not None: # already inferred
-			# 	try:
-			# 		parsed_value = parse_defined_field(values[i], field_definition)
-			# 		parsed_fields[key] = parsed_value
-			# 	except:
-			# 		raise NotImplemented
-			# 	continue
+def split_values(field):
+	"""Converter of undefined fields."""
+	return field.split(',')
+
+class ParserState(object):
+	"""What a parser learns about a file while going through its records:
+	fields that have no definition at all, inferred fields whose values
+	did not fit the inferred type and bad INFO fields already warned about.
+	Every parser has its own, so parsers running together never mix them up."""
+
+	def __init__(self):
+		self.undefined_infos = set()
+		self.undefined_formats = set()
+		self.demoted_fields = set()
+		self.bad_info_fields = set()
+		self.sample_formats = {}
+
+	def converters(self, headers):
+		"""Same as header_converters(), but the converters of inferred fields 
+		fall back to lists of strings instead of raising ValueError."""
+		info_converters, format_converters = header_converters(headers)
+		info_converters = dict(info_converters)
+		format_converters = dict(format_converters)
+		for section, definitions, converters in (('INFO', headers.infos, info_converters), ('FORMAT', headers.formats, format_converters)):
+			for ID, definition in definitions.items():
+				if definition[2] == INFERRED_DESCRIPTION and ID in converters:
+					converters[ID] = self.fallback_converter(section, ID, definition, converters[ID])
+		return info_converters, format_converters
+
+	def sample_format(self, format_field, format_converters):
+		"""Returns the SampleFormat of a FORMAT string, built once per file."""
+		sample_format = self.sample_formats.get(format_field)
+		if sample_format is None:
+			keys = format_field.split(':')
+			self.undefined_formats.update(key for key in keys if key not in format_converters and key != 'GT')
+			sample_format = SampleFormat(keys, [format_converters.get(key, split_values) for key in keys])
+			self.sample_formats[format_field] = sample_format
+		return sample_format
+
+	def warn_undefined_fields(self):
+		"""Reports the fields used without a definition that could not be 
+		inferred either (first met after the sampled records), once all the
+		records have been parsed."""
+		undefined = ['{} `{}`'.format(section, ID) for section, fields in (('INFO', self.undefined_infos), ('FORMAT', self.undefined_formats))
+						for ID in sorted(fields)]
+		if undefined:
+			print('Warning: fields used without a definition, their values have been stored as lists of strings: {}.'.format(', '.join(undefined)))
+
+	def fallback_converter(self, section, ID, definition, converter):
+		def convert(field):
+			try:
+				return converter(field)
+			except ValueError:
+				if (section, ID) not in self.demoted_fields:
+					self.demoted_fields.add((section, ID))
+					print('Warning: {} field `{}` was inferred as {} from the first records but has value `{}`, values that do not fit are stored as strings. Will not notify ulterior errors with the same field ID.'.format(
+						section, ID, definition[1], field))
+				return field.split(',')
+		return convert
+
+
+
+def infer_field_types(filestream, headers, sample_size=INFERENCE_SAMPLE_SIZE):
+	"""Reads the first `sample_size` records, adds a definition for each 
+	INFO and FORMAT field they use without defining it to `headers`, and
+	returns an iterator over all the records lines (sampled ones included).
+	Definitions are `Integer` or `Float` if all the sampled values are 
+	numbers, `Flag` for INFO keys without values, `String` otherwise, 
+	with Number `1` if no value had commas and `.` if some had."""
+	sampled_lines = list(itertools.islice(filestream, sample_size))
+
+	info_values = defaultdict(list)
+	format_values = defaultdict(list)
+	for line in sampled_lines:
+		fields = line.rstrip('\r\n').split('\t')
+		if len(fields) > 7 and fields[7] != '.':
+			for kv in fields[7].split(';'):
+				key, equal_sign, value = kv.partition('=')
+				if key not in headers.infos and key not in standard_info_fields:
+					info_values[key].append(value if equal_sign else None)
+		if len(fields) > 9:
+			fieldnames = fields[8].split(':')
+			undefined = [(i, key) for i, key in enumerate(fieldnames) 
+							if key != 'GT' and key not in headers.formats and key not in standard_format_fields]
+			for sample in fields[9:]:
+				values = sample.split(':')
+				for i, key in undefined:
+					if i < len(values):
+						format_values[key].append(values[i])
+
+	for key, values in info_values.items():
+		headers.infos[key] = infer_definition(values)
+	for key, values in format_values.items():
+		headers.formats[key] = infer_definition(values)
+
+	return itertools.chain(sampled_lines, filestream)
+
+
+
+def infer_definition(values):
+	"""Definition ([Number, Type, Description]) fitting all the sampled 
+	values of a field, None values stand for INFO flags."""
+	if all(value is None for value in values):
+		return ['0', 'Flag', INFERRED_DESCRIPTION]
+	if any(value is None for value in values):
+		return ['.', 'String', INFERRED_DESCRIPTION]
+
+	Number = '1' if all(',' not in value for value in values) else '.'
+	items = [x for value in values for x in value.split(',') if x != '.']
+	for Type, cast in (('Integer', int), ('Float', float)):
+		try:
+			for x in items:
+				cast(x)
+		except ValueError:
+			continue
+		if items:
+			return [Number, Type, INFERRED_DESCRIPTION]
+	return [Number, 'String', INFERRED_DESCRIPTION]
 
-		parsed_samples.append(parsed_fields)
 
-	return parsed_samples
 
-def parse_defined_field(field, definition):
-	"""Checks the field definition and does the actual
-	conversion to the proper type. If value and definition
-	are incompatible raises ValueError."""
+def compile_field_converter(definition):
+	"""Checks the field definition and returns a function doing
+	the actual conversion to the proper type. If value and 
+	definition are incompatible the function raises ValueError."""
 
 	# Flags are already unpacked while attempting to split 
 	# over '=' when parsing INFO fields.
-	# if definition[1] == 'Flag':
-	# 	return True
+	Number, Type = definition[0], definition[1]
 
-	if field == '.':
-		return ['.']
+	if Type in ('String', 'Character'):
+		if Number == '1':
+			return lambda field: ['.'] if field == '.' else field
+		return lambda field: ['.'] if field == '.' else field.split(',')
 
-	if definition[0] == '1':
+	cast = float if Type == 'Float' else int
 
-		if definition[1] in ('String', 'Character'):
-			return field
+	if Number == '1':
+		return lambda field: ['.'] if field == '.' else cast(field)
+	return lambda field: ['.'] if field == '.' else list(None if x == '.' else cast(x) for x in field.split(','))
 
-		if field == '.':
-			return None
+def parse_defined_field(field, definition):
+	"""Does the conversion of a single value to the type 
+	described by `definition`. If value and definition
+	are incompatible raises ValueError."""
+	return compile_field_converter(definition)(field)
 
-		if definition[1] == 'Float':
-			return float(field)
-		return int(field)
-	
-	if definition[1] in ('String', 'Character'):
-		return field.split(',')
 
-	if definition[1] == 'Float':
-		return list(None if x == '.' else float(x) for x in field.split(','))
-	
-	return list(None if x == '.' else int(x) for x in field.split(','))
+#
+# NORMALIZATION
+#
+
+def normalize_records(records, headers):
+	"""Brings records to a minimal representation so that the same
+	variant described by different callers ends up at the same POS
+	with the same REF: alleles are trimmed of the bases they share,
+	multi-allelic records whose alleles end up at different positions
+	are split, and records of the same file that end up at the same 
+	position are joined back together (one record per position is what 
+	`parse_records_together` and the DB documents expect).
+	The only context used is the REF of each record: indels are 
+	left-aligned as far as REF allows, no reference genome is needed.
+	Records are buffered only while their position can still change."""
+
+	buffer = [] # heap of (POS, arrival order, record)
+	arrival = 0
+	CHROM = None
+	for record in records:
+		if record.CHROM != CHROM:
+			for normalized in pop_normalized(buffer, float('inf'), headers):
+				yield normalized
+			CHROM = record.CHROM
+
+		# Trimming can only move records forward, 
+		# everything before this position is final.
+		for normalized in pop_normalized(buffer, record.POS, headers):
+			yield normalized
+
+		for split in split_record(record, headers):
+			heapq.heappush(buffer, (split.POS, arrival, split))
+			arrival += 1
+
+	for normalized in pop_normalized(buffer, float('inf'), headers):
+		yield normalized
+
+def pop_normalized(buffer, POS, headers):
+	while buffer and buffer[0][0] < POS:
+		group = [heapq.heappop(buffer)[2]]
+		while buffer and buffer[0][0] == group[0].POS:
+			group.append(heapq.heappop(buffer)[2])
+		for record in join_records(group, headers):
+			yield record
+
+def trim_alleles(POS, REF, ALT):
+	"""Removes the bases shared by REF and ALT, first from the right
+	then from the left (moving POS accordingly), always leaving at 
+	least one base in each allele."""
+	while len(REF) > 1 and len(ALT) > 1 and REF[-1] == ALT[-1]:
+		REF, ALT = REF[:-1], ALT[:-1]
+	while len(REF) > 1 and len(ALT) > 1 and REF[0] == ALT[0]:
+		REF, ALT = REF[1:], ALT[1:]
+		POS += 1
+	return POS, REF, ALT
+
+def is_symbolic(allele):
+	return allele in ('.', '*') or allele.startswith('<') or '[' in allele or ']' in allele
+
+def split_record(record, headers):
+	if any(is_symbolic(allele) for allele in record.ALT):
+		return [record]
+
+	trimmed = [trim_alleles(record.POS, record.REF, allele) for allele in record.ALT]
+	positions = sorted(set(POS for POS, _, _ in trimmed))
+
+	split = []
+	for POS in positions:
+		alleles = [i + 1 for i, (allele_POS, _, _) in enumerate(trimmed) if allele_POS == POS]
+		REF = max((trimmed[i - 1][1] for i in alleles), key=len)
+		ALT = [trimmed[i - 1][2] + REF[len(trimmed[i - 1][1]):] for i in alleles]
+		if len(positions) == 1:
+			split.append(record._replace(POS=POS, REF=REF, ALT=ALT))
+			continue
+
+		# Alleles that moved elsewhere are treated as REF in this record.
+		mapping = dict((old, new + 1) for new, old in enumerate(alleles))
+		split.append(record._replace(POS=POS, REF=REF, ALT=ALT,
+			INFO=dict((key, subset_field(value, headers.infos.get(key), len(record.ALT), alleles)) 
+				for key, value in record.INFO.items()),
+			samples=[dict((key, recode_genotype(value, mapping) if key == 'GT' else 
+					subset_field(value, headers.formats.get(key), len(record.ALT), alleles))
+				for key, value in sample.items()) for sample in record.samples]))
+	return split
+
+def join_records(records, headers):
+	"""Joins records of the same file found at the same position
+	into a single multi-allelic record."""
+	if len(records) == 1:
+		return records
+
+	REF = max((record.REF for record in records), key=len)
+	if not all(REF.startswith(record.REF) for record in records) \
+	    or any(is_symbolic(allele) for record in records for allele in record.ALT):
+		return records
+	records = [pad_alleles(record, REF) for record in records]
+
+	ALT = []
+	mappings = []
+	for record in records:
+		mapping = {0: 0}
+		for i, allele in enumerate(record.ALT):
+			if allele not in ALT:
+				ALT.append(allele)
+			mapping[i + 1] = ALT.index(allele) + 1
+		mappings.append(mapping)
+
+	IDs = []
+	for record in records:
+		for ID in record.ID.split(';'):
+			if ID != '.' and ID not in IDs:
+				IDs.append(ID)
+
+	FILTERs = []
+	for record in records:
+		for FILTER in record.FILTER.split(';'):
+			if FILTER not in FILTERs:
+				FILTERs.append(FILTER)
+	if len(FILTERs) > 1:
+		FILTERs = [f for f in FILTERs if f not in ('PASS', '.')]
+
+	INFO = {}
+	for record, mapping in zip(records, mappings):
+		for key, value in record.INFO.items():
+			INFO[key] = join_field(INFO.get(key), value, headers.infos.get(key), len(record.ALT), mapping, len(ALT))
+
+	samples = []
+	for sample_data in zip(*(record.samples for record in records)):
+		sample = {}
+		# Non-REF calls win over REF calls from the other records.
+		GTs = [re.split(r'[|/]', recode_genotype(data['GT'], mapping)) 
+				for data, mapping in zip(sample_data, mappings) if isinstance(data.get('GT'), str)]
+		for data, mapping, record in zip(sample_data, mappings, records):
+			for key, value in data.items():
+				if key != 'GT':
+					sample[key] = join_field(sample.get(key), value, headers.formats.get(key), len(record.ALT), mapping, len(ALT))
+		if GTs and all(len(GT) == len(GTs[0]) for GT in GTs):
+			separator = '|' if all('|' in data['GT'] for data in sample_data if isinstance(data.get('GT'), str)) else '/'
+			sample['GT'] = separator.join(next((a for a in alleles if a not in ('0', '.')), alleles[0]) for alleles in zip(*GTs))
+		elif any('GT' in data for data in sample_data):
+			sample['GT'] = next(data['GT'] for data in sample_data if 'GT' in data)
+		samples.append(sample)
+
+	return [records[0]._replace(
+		ID=';'.join(IDs) or '.',
+		ALT=ALT,
+		QUAL=max(record.QUAL for record in records),
+		FILTER=';'.join(FILTERs),
+		INFO=INFO,
+		samples=samples)]
+
+def pad_alleles(record, REF):
+	"""Extends REF and ALT alleles of a record with the 
+	missing bases of a longer REF at the same position."""
+	if record.REF == REF or not REF.startswith(record.REF) \
+	    or any(is_symbolic(allele) for allele in record.ALT):
+		return record
+	padding = REF[len(record.REF):]
+	return record._replace(REF=REF, ALT=[allele + padding for allele in record.ALT])
+
+def recode_genotype(GT, mapping):
+	"""Renumbers the alleles of a GT string, alleles 
+	missing from `mapping` become REF."""
+	if not isinstance(GT, str):
+		return GT
+	return ''.join(x if x in '|/.' else str(mapping.get(int(x), 0)) for x in re.split(r'([|/])', GT))
+
+def subset_field(value, definition, num_alts, alleles):
+	"""Keeps only the values pertaining the selected alleles for 
+	fields defined with Number=A, R or G (diploid)."""
+	if definition is None or not isinstance(value, list):
+		return value
+	Number = definition[0]
+
+	if Number == 'A' and len(value) == num_alts:
+		return [value[i - 1] for i in alleles]
+	if Number == 'R' and len(value) == num_alts + 1:
+		return [value[0]] + [value[i] for i in alleles]
+	if Number == 'G' and len(value) == (num_alts + 1) * (num_alts + 2) // 2:
+		alleles = [0] + alleles
+		return [value[genotype_index(alleles[a], alleles[b])] for b in range(len(alleles)) for a in range(b + 1)]
+	return value
+
+def join_field(joined, value, definition, num_alts, mapping, num_joined_alts):
+	"""Adds the values of a field to those already joined from other
+	records. Values of Number=A or R fields are moved to the position of 
+	their allele in the joined record, other fields keep the first value."""
+	if definition is None or not isinstance(value, list) or definition[0] not in ('A', 'R'):
+		return value if joined is None else joined
+
+	offset = 1 if definition[0] == 'A' else 0
+	if len(value) != num_alts + 1 - offset:
+		return value if joined is None else joined
+
+	if joined is None:
+		joined = [None] * (num_joined_alts + 1 - offset)
+	for i, v in enumerate(value):
+		j = mapping[i + offset] - offset
+		if joined[j] is None:
+			joined[j] = v
+	return joined
+
+def genotype_index(a, b):
+	"""Position of the diploid genotype a/b in Number=G fields."""
+	a, b = min(a, b), max(a, b)
+	return b * (b + 1) // 2 + a
+
 
 
 #
@@ -431,53 +1006,166 @@ def parse_defined_field(field, definition):
 #
 
 
-def parse_vcf_together(filestreams, ignore_bad_info=False):
-	headers, samples = parse_headers_together(filestreams)
-	return headers, samples, parse_records_together(zip(filestreams, headers), ignore_bad_info=ignore_bad_info)
+def parse_vcf_together(filestreams, ignore_bad_info=False, normalize=False, genotypes_only=False, 
+	infer_types=INFERENCE_SAMPLE_SIZE, buffer_size=READ_BUFFER_SIZE, samples=None, sort=False):
+	if buffer_size:
+		filestreams = [LineReader(f, buffer_size) if is_binary(f) else f for f in filestreams]
+	headers, file_samples = parse_headers_together(filestreams)
+	columns = None
+	if samples is not None:
+		columns = [select_columns(s, samples) for s in file_samples]
+		file_samples = tuple([s[i] for i in c] for s, c in zip(file_samples, columns))
+	lines = filestreams
+	if infer_types and not genotypes_only:
+		lines = [infer_field_types(f, h, infer_types) for f, h in zip(filestreams, headers)]
+	return headers, file_samples, parse_records_together(list(zip(lines, headers)), ignore_bad_info=ignore_bad_info, 
+		normalize=normalize, genotypes_only=genotypes_only, columns=columns, sort=sort)
 
 def parse_headers_together(filestreams):
 	return zip(*(parse_headers(f) for f in filestreams))
 	
 
-def parse_records_together(fs_headers_touple_list, ignore_bad_info=False):
-	parsers = tuple(parse_records(fs, head, ignore_bad_info=ignore_bad_info) for fs, head in fs_headers_touple_list)
+def parse_records_together(fs_headers_touple_list, ignore_bad_info=False, normalize=False, genotypes_only=False, columns=None,
+	sort=False):
+	"""Walks the records of many files at once, yielding the records at 
+	the same position together. Files must be sorted by CHROM (in the
+	order of ContigOrder) and POS, UnsortedFile is raised as soon as one 
+	turns out not to be. With `sort` every file first goes through 
+	sort_records(), CHROMs without a `##contig` line are then sorted as text."""
+	if columns is None:
+		columns = [None] * len(fs_headers_touple_list)
+	order = ContigOrder([head for _, head in fs_headers_touple_list], by_name=sort)
+	parsers = tuple(parse_records(fs, head, ignore_bad_info=ignore_bad_info, genotypes_only=genotypes_only, columns=c) 
+					for (fs, head), c in zip(fs_headers_touple_list, columns))
+	if sort:
+		parsers = tuple(sort_records(p, key=order.record_key) for p in parsers)
+	if normalize:
+		parsers = tuple(normalize_records(p, head) for p, (_, head) in zip(parsers, fs_headers_touple_list))
 
 	## RECORDS ##
 	record_buffer = list(next(p, None) for p in parsers)
+	keys = [None if record is None else order.record_key(record) for record in record_buffer]
 	exhausted_parsers = sum((1 if record is None else 0 for record in record_buffer))
 	while exhausted_parsers < len(fs_headers_touple_list):
-		selected_records = []
-		selected_records_ids = []
-		lowest_chrom = '~~~~~~~~~~~~~~~~~~'
-		# ~ is the highest ascii valued printable character, lexicographical max_value somehow
-		lowest_pos = float('inf')
-
-		for i, record in enumerate(record_buffer):
-			# a better approach is possible ^^^^
-			if record is None:
-				continue
-
-			if (record.CHROM == lowest_chrom and record.POS < lowest_pos) \
-			    or record.CHROM < lowest_chrom:
-				selected_records = [record]
-				selected_records_ids = [i]
-				lowest_chrom = record.CHROM
-				lowest_pos = record.POS
-
-			elif record.CHROM == lowest_chrom and record.POS == lowest_pos:
-				selected_records.append(record)
-				selected_records_ids.append(i)
+		lowest = min(key for key in keys if key is not None)
+		selected_records_ids = [i for i, key in enumerate(keys) if key == lowest]
+		selected_records = [record_buffer[i] for i in selected_records_ids]
 
 		for record_id in selected_records_ids:
 			new_record = next(parsers[record_id], None)
 			if new_record is None:
 				exhausted_parsers += 1
+				keys[record_id] = None
+			else:
+				keys[record_id] = order.record_key(new_record)
+				if keys[record_id] < lowest and len(parsers) > 1:
+					# A single file needs no order to be walked.
+					previous = selected_records[selected_records_ids.index(record_id)]
+					raise UnsortedFile(record_id, new_record.CHROM, new_record.POS, previous.CHROM, previous.POS)
 			record_buffer[record_id] = new_record
 
+		if normalize:
+			# Normalized records at the same position might still 
+			# differ in how much REF context they carry.
+			REF = max((record.REF for record in selected_records), key=len)
+			selected_records = [pad_alleles(record, REF) for record in selected_records]
+
 		yield zip(selected_records_ids, selected_records)
 
 
 
+
+#
+# SORTING
+#
+
+class ContigOrder(object):
+	"""Order of the CHROMs of files walked together: the ones declared in 
+	the `##contig` lines of the headers come first, in the order of the 
+	lines (of the first file declaring them). The others follow in the 
+	order they are first met in the records, the same for all the files, 
+	or as text with `by_name` (when every file is sorted beforehand).
+
+	>>> order = ContigOrder()
+	>>> order.key('9', 100) < order.key('10', 100) < order.key('X', 1)
+	True
+	>>> order = ContigOrder(by_name=True)
+	>>> order.key('9', 100) < order.key('10', 100)
+	False
+	"""
+	def __init__(self, headers_list=(), by_name=False):
+		self.by_name = by_name
+		self.ranks = {}
+		for headers in headers_list:
+			for value in headers.extra.get('contig', ()):
+				CHROM = parse_header_attributes(value.strip()[1:-1]).get('ID')
+				if CHROM is not None and CHROM not in self.ranks:
+					self.ranks[CHROM] = len(self.ranks)
+
+	def key(self, CHROM, POS):
+		rank = self.ranks.get(CHROM)
+		if rank is None:
+			if self.by_name:
+				return (1, CHROM, POS)
+			#else
+			rank = self.ranks[CHROM] = len(self.ranks)
+		return (0, rank, POS)
+
+	def record_key(self, record):
+		return self.key(record.CHROM, record.POS)
+
+
+def sort_records(records, run_size=SORT_RUN_SIZE, key=None):
+	"""External merge sort of records by `key` (CHROM as text and POS by
+	default): sorted runs of `run_size` records are pickled to temporary 
+	files and then merged back, so memory usage stays bounded whatever 
+	the file size. Records at the same position keep their order. Inputs 
+	that fit in a single run never touch the disk."""
+	key = key or record_position
+	records = iter(records)
+	runs = []
+	while True:
+		run = list(itertools.islice(records, run_size))
+		if len(run) < run_size and not runs:
+			for record in sorted(run, key=key):
+				yield record
+			return
+		if not run:
+			break
+		runs.append(spill_run(sorted(run, key=key)))
+
+	for _, record in heapq.merge(*[read_run(run, i, key) for i, run in enumerate(runs)]):
+		yield record
+
+
+def record_position(record):
+	return (record.CHROM, record.POS)
+
+
+def spill_run(records):
+	run = tempfile.TemporaryFile()
+	pickler = pickle.Pickler(run, pickle.HIGHEST_PROTOCOL)
+	for record in records:
+		pickler.dump(record)
+		# The pickler would otherwise keep every record alive to share references.
+		pickler.clear_memo()
+	run.seek(0)
+	return run
+
+
+def read_run(run, run_index, key=record_position):
+	"""Yields the records of a spilled run decorated for heapq.merge(), 
+	run index and order inside the run keep the merge stable."""
+	unpickler = pickle.Unpickler(run)
+	try:
+		for i in itertools.count():
+			record = unpickler.load()
+			yield (key(record), run_index, i), record
+	except EOFError:
+		run.close()
+
+
+
 if __name__ == '__main__':
 	pass
 	# TODO: tests
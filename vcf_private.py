@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
-import re
+from __future__ import print_function
+import os, re, time
 try:
 	import rethinkdb as r
 except:
@@ -8,6 +9,8 @@ except:
 	print('To install: pip install rethinkdb')
 	print('\n')
 	raise ImportError
+from vcf_query import check_position_index, parse_region, region_query
+from vcf_privates_index import MISSING_POLICIES, PrivatesIndex, build_from_collection, build_from_vcf_files, index_stats
 
 
 class BadDatabase(Exception):
@@ -29,18 +32,27 @@ def main():
 	parser.add_argument('--db', default='VCF', 
 		help='Database name where the VCF data is stored. Defaults to `VCF`.')
 
-	parser.add_argument('collection', 
+	collection_parser = argparse.ArgumentParser(add_help=False)
+	collection_parser.add_argument('collection', 
 		help='Name of the collection that you want to query or whose indexes manage.')
 
+	policy_parser = argparse.ArgumentParser(add_help=False)
+	policy_parser.add_argument('--phased', action='store_true',
+		help='Compare genotypes taking phase into account (`0|1` != `1|0` != `0/1`). By default the order of the alleles is ignored.')
+	policy_parser.add_argument('--alleles-only', action='store_true',
+		help='Compare only which alleles are called, regardless of ploidy and zygosity (`0/1` == `0/1/1`, `1` == `1/1`).')
+	policy_parser.add_argument('--missing', choices=MISSING_POLICIES, default='exclude',
+		help='How to treat missing calls: `exclude` leaves them out of every group (default), `wildcard` lets them match any genotype.')
+
 
 	subparsers = parser.add_subparsers(dest='command')
 
 	## LIST ##
-	parser_list = subparsers.add_parser('list', 
+	parser_list = subparsers.add_parser('list', parents=[collection_parser],
 		help='List all indexes in collection.')
 
 	## CREATE ##
-	parser_create = subparsers.add_parser('create', 
+	parser_create = subparsers.add_parser('create', parents=[collection_parser, policy_parser],
 		help='Create a new index optionally specifying quality or coverage tresholds.')
 	parser_create.add_argument('name',  
 		help='Name of the new index.')
@@ -52,15 +64,21 @@ def main():
 		help='Index only variants that are SNPs (both REF and ALT values are single nucleotides).')
 	parser_create.add_argument('--apply-filters', action='store_true',
 		help='Index only variants that have `PASS` or `.` as FILTER values.')
+	parser_create.add_argument('--workers', type=int,
+		help='Build the index as a file (see --output) using this many processes, each one working on a subset of the chromosomes.')
+	parser_create.add_argument('--vcf', nargs='+',
+		help='Build the index file straight from these VCF files instead of from the collection.')
+	parser_create.add_argument('--output',
+		help='Where to save the index file. Defaults to `<collection>.<name>.idx`. Index files are registered in the collection and queried with `get` as usual.')
 
 	## DELETE ##
-	parser_delete = subparsers.add_parser('delete', 
+	parser_delete = subparsers.add_parser('delete', parents=[collection_parser],
 		help='Delete an index.')
 	parser_delete.add_argument('name',  
 		help='Index name.')
 
 	## GET ##
-	parser_get = subparsers.add_parser('get', 
+	parser_get = subparsers.add_parser('get', parents=[collection_parser],
 		help='Get a VCF containing only private SNPs. Must query a previously built index.')
 	parser_get.add_argument('name',  
 		help='Index name.')
@@ -70,11 +88,96 @@ def main():
 		help='Privates of `plus_group` are evaluated against all remaining samples in the collection. To exclude some samples from this second group list them here.')
 	parser_get.add_argument('--merge',  
 		help='nome indice')
+	parser_get.add_argument('--region',
+		help='Only look for privates inside a region, eg: `20:1000000-2000000`. Scans the region in genomic order instead of using the index.')
+	parser_get.add_argument('--batch-size', default=1000, type=int,
+		help='How many records are fetched at a time when the index is a file. Defaults to 1000.')
+
+	## BUILD-FROM-VCF ##
+	parser_build = subparsers.add_parser('build-from-vcf', parents=[policy_parser],
+		help='Build an index file straight from some VCF files, without importing them in the database.')
+	parser_build.add_argument('output',
+		help='Where to save the index file.')
+	parser_build.add_argument('vcf_filenames', metavar='file', nargs='+',
+		help='A VCF file (optionally gzipped).')
+	parser_build.add_argument('--workers', type=int, default=1,
+		help='Number of processes, each one working on a subset of the chromosomes. Defaults to 1.')
+
+	## QUERY ##
+	parser_query = subparsers.add_parser('query',
+		help='Get the private positions of a group of samples from an index file.')
+	parser_query.add_argument('index',
+		help='Index file.')
+	parser_query.add_argument('sample', metavar='samples', nargs='+',
+		help='Sample names that form the group whose privates must be returned.')
+	parser_query.add_argument('--ignore', nargs='+',
+		help='Samples that are not part of the group but whose genotypes should not be considered.')
+	parser_query.add_argument('--region',
+		help='Only return privates inside a region, eg: `20:1000000-2000000`.')
+
+	## SHARED ##
+	parser_shared = subparsers.add_parser('shared',
+		help='Get the positions where all the samples of a group have the same genotype, whatever the other samples have, from an index file.')
+	parser_shared.add_argument('index',
+		help='Index file.')
+	parser_shared.add_argument('sample', metavar='samples', nargs='+',
+		help='Sample names that form the group.')
+	parser_shared.add_argument('--region',
+		help='Only return positions inside a region, eg: `20:1000000-2000000`.')
+
+	## STATS ##
+	parser_stats = subparsers.add_parser('stats',
+		help='Show the size and shape of an index file: class keys, how positions distribute over class sizes, the groups with most privates and per-sample singletons.')
+	parser_stats.add_argument('index',
+		help='Index file.')
+	parser_stats.add_argument('--top', type=int, default=10,
+		help='How many of the groups with most privates to show. Defaults to 10.')
 
 	args = parser.parse_args()
 
 
-	print args
+	print(args)
+
+
+	# Index files don't need the database.
+	if args.command == 'build-from-vcf':
+		start_time = time.time()
+		index = build_from_vcf_files(args.vcf_filenames, args.workers, 
+					phased=args.phased, alleles_only=args.alleles_only, missing=args.missing)
+		index.save(args.output)
+		print('# Indexed {} positions of {} samples in {:.1f} seconds, saved to {}.'.format(
+			index.size, len(index.samples), time.time() - start_time, args.output))
+		exit(0)
+
+	if args.command == 'stats':
+		stats = index_stats(args.index, args.top)
+		print('# {positions} positions, {samples} samples, {keys} class keys'.format(**stats))
+		print('# {:.1f} MB stored, {:.1f} bytes per key'.format(stats['bytes'] / 1e6, stats['bytes_per_key']))
+		print('')
+		print('class size\tkeys\tpositions')
+		for size, (keys, positions) in sorted(stats['class_sizes'].items()):
+			print('{}\t{}\t{}'.format(size, keys, positions))
+		print('')
+		print('privates\tgroup')
+		for group, positions in stats['top_groups']:
+			print('{}\t{}'.format(positions, ','.join(group)))
+		print('')
+		print('sample\tsingletons')
+		for sample, positions in sorted(stats['singletons'].items()):
+			print('{}\t{}'.format(sample, positions))
+		exit(0)
+
+	if args.command == 'query':
+		index = PrivatesIndex.load(args.index)
+		for CHROM, POS in region_privates(index, args.sample, args.ignore, args.region):
+			print('{}\t{}'.format(CHROM, POS))
+		exit(0)
+
+	if args.command == 'shared':
+		index = PrivatesIndex.load(args.index)
+		for CHROM, POS in index.shared(args.sample, region=index_region(args.region)):
+			print('{}\t{}'.format(CHROM, POS))
+		exit(0)
 
 
 	# Connect to RethinkDB
@@ -91,29 +194,40 @@ def main():
 
 
 
+	metadata = r.table('__METADATA__').get(args.collection).run(db_connection) or {}
+	privates_indexes = metadata.get('privates_indexes', {})
+
 	if args.command == 'list':
 		try:
-			print r.table(args.collection).index_list().run(db_connection)
+			print(r.table(args.collection).index_list().run(db_connection))
 		except:
 			raise BadCollection('collection {} does not exist.'.format(args.collection))
+		for name, policy in sorted(privates_indexes.items()):
+			if 'file' in policy:
+				print('{} (file: {})'.format(name, policy['file']))
 		exit(1)
 
 	if args.command == 'create':
+		policy = {'phased': args.phased, 'alleles_only': args.alleles_only, 'missing': args.missing}
 
+		if args.workers is not None or args.vcf is not None or args.output is not None:
+			output = os.path.abspath(args.output or '{}.{}.idx'.format(args.collection, args.name))
+			start_time = time.time()
+			if args.vcf is not None:
+				index = build_from_vcf_files(args.vcf, args.workers or 1, **policy)
+			else:
+				index = build_from_collection(db_connection, args.collection, args.workers or 1, **policy)
+			index.save(output)
+			print('# Indexed {} positions in {:.1f} seconds, saved to {}.'.format(index.size, time.time() - start_time, output))
 
-		for x in list(r.table(args.collection).map( 
-			lambda record: record['samples'].keys().group(
-				lambda sample: record['samples'].get_field(sample)['GT']).ungroup()['reduction']
-			).run(db_connection)):
-			print ''
-			for y in x:
-				print ':::', y
-			print ''
+			r.table('__METADATA__').get(args.collection).update({'privates_indexes': {args.name: dict(policy, file=output)}}).run(db_connection)
+			exit(0)
 
-		print r.table(args.collection).index_create(args.name, 
-			lambda record: record['samples'].keys().group(
-				lambda sample: record['samples'].get_field(sample)['GT']).ungroup()['reduction']
-			, multi=True).run(db_connection)
+
+		print(r.table(args.collection).index_create(args.name, lambda record: privates_classes(record, **policy), multi=True).run(db_connection))
+
+		# Queries not using the index need to know how it was built.
+		r.table('__METADATA__').get(args.collection).update({'privates_indexes': {args.name: policy}}).run(db_connection)
 
 		exit(0)
 
@@ -122,16 +236,88 @@ def main():
 
 
 	if args.command == 'delete':
-		r.table(args.collection).index_drop
+		if 'file' in privates_indexes.get(args.name, {}):
+			if os.path.exists(privates_indexes[args.name]['file']):
+				os.remove(privates_indexes[args.name]['file'])
+		else:
+			r.table(args.collection).index_drop(args.name).run(db_connection)
+		r.table('__METADATA__').get(args.collection).replace(lambda x: x.without({'privates_indexes': {args.name: True}})).run(db_connection)
+		exit(0)
 
 	if args.command == 'get':
 		import json
 
-		for x in r.table(args.collection).get_all(args.sample, index=args.name).run(db_connection):
-			print ''
-			print x['id'], ':'
-			print json.dumps(x['samples'], sort_keys=True, indent=2)
-			print ''
+		policy = dict(privates_indexes.get(args.name, {}))
+		if 'file' in policy:
+			positions = region_privates(PrivatesIndex.load(policy['file']), args.sample, args.ignore, args.region)
+			records = position_records(db_connection, args.collection, positions, args.batch_size)
+		elif args.region is None:
+			records = r.table(args.collection).get_all(sorted(args.sample), index=args.name).run(db_connection)
+		else:
+			check_position_index(db_connection, args.collection)
+			records = region_query(args.collection, args.region) \
+						.filter(lambda record: privates_classes(record, **policy).contains(sorted(args.sample))).run(db_connection)
+
+		for x in records:
+			print('')
+			print(x['id'], ':')
+			print(json.dumps(x['samples'], sort_keys=True, indent=2))
+			print('')
+
+
+def position_records(db, collection, positions, batch_size=1000):
+	"""Yields the records at some (CHROM, POS) positions, in the same 
+	order, fetched `batch_size` at a time."""
+	for start in range(0, len(positions), batch_size):
+		ids = ['{}-{}'.format(CHROM, POS) for CHROM, POS in positions[start:start + batch_size]]
+		records = dict((record['id'], record) for record in r.table(collection).get_all(*ids).run(db))
+		for record_id in ids:
+			if record_id in records:
+				yield records[record_id]
+
+
+def region_privates(index, samples, ignore=None, region=None):
+	"""Privates from an index file, optionally only inside a region."""
+	return index.privates(samples, ignore=ignore, region=index_region(region))
+
+
+def index_region(region):
+	"""A region string as the (CHROM, START, END) tuple used by index files."""
+	if region is None:
+		return None
+	chrom, start, end = parse_region(region)
+	return (chrom, start if isinstance(start, int) else float('-inf'), end if isinstance(end, int) else float('inf'))
+
+
+def privates_classes(record, phased=False, alleles_only=False, missing='exclude'):
+	"""Groups the samples of a record by GT, each group is a 
+	key of the privates index (see computing-privates-all-groupings.md).
+	The comparison policies are the same of vcf_privates_index.PrivatesIndex:
+	with `missing='wildcard'` samples with a missing call (`.`, `./.`) 
+	join every group. Samples that have no data at all for the record
+	(their VCF file lacks the position) are always left out."""
+	samples = record['samples']
+	calls = samples.keys().map(lambda sample: [sample, genotype_key(samples.get_field(sample)['GT'].default(['.']), phased, alleles_only)])
+	called = calls.filter(lambda call: call[1].ne(None))
+	classes = called.group(lambda call: call[1]).map(lambda call: call[0]).ungroup()['reduction']
+	if missing == 'wildcard':
+		missing_samples = calls.filter(lambda call: call[1].eq(None)).map(lambda call: call[0])
+		classes = classes.map(lambda group: group.union(missing_samples).order_by(lambda sample: sample))
+	return classes
+
+
+def genotype_key(GT, phased=False, alleles_only=False):
+	"""ReQL version of vcf_privates_index.genotype_key()
+	for GTs stored as lists (['A', '|', 'C']), null if missing."""
+	alleles = GT.filter(lambda x: r.expr(['|', '/']).contains(x).not_())
+	called = alleles.filter(lambda x: x.ne('.'))
+	if alleles_only:
+		key = called.distinct()
+	elif phased:
+		key = GT
+	else:
+		key = alleles.order_by(lambda x: x)
+	return r.branch(called.is_empty(), None, key)
 
 
 def check_and_select_db(connection, db_name):
@@ -0,0 +1,806 @@
+from __future__ import print_function, division
+import binascii, bisect, gzip, itertools, json, re, zlib
+import multiprocessing
+from collections import defaultdict
+from vcf_miniparser import parse_headers, parse_records_together, UnsortedFile
+try:
+	import numpy as np
+except:
+	print('Unable to import the NumPy python module.')
+	print('To install: pip install numpy')
+	print('\n')
+	raise ImportError
+
+
+# See computing-privates-all-groupings.md for how the index works.
+# Keys of the index are equivalence classes of samples (the samples
+# sharing the same genotype at a position) represented as bitmasks:
+# bit i is set if the i-th sample belongs to the class. Values are
+# the (increasing) row numbers of the positions where the class appears,
+# kept compressed in PositionLists.
+
+# Policies for missing calls: `exclude` leaves missing samples out of
+# every class of the position, `wildcard` adds them to all the classes
+# (a missing call could be any genotype).
+MISSING_POLICIES = ('exclude', 'wildcard')
+
+# Negative genotype codes of extend_block(): a missing call, or no data at
+# all (the VCF file of the sample lacks the position). Samples without
+# data are left out of every class, whatever the missing calls policy.
+MISSING_CALL = -1
+NO_DATA = -2
+
+# Rows processed at a time by from_matrix().
+BLOCK_SIZE = 4096
+
+# Position lists keep a skip pointer every this many rows.
+SKIP_INTERVAL = 128
+
+# Odd 64 bit multipliers used to hash bitmasks word by word.
+HASH_WEIGHTS = [(0x9e3779b97f4a7c15 * (2 * i + 1)) & 0xffffffffffffffff for i in range(4096)]
+
+
+class PrivatesIndex(object):
+	"""
+	Usage:
+
+	Let sA = "ACGT", sB = "ACG", sC = "ATC":
+
+	>>> index = PrivatesIndex(['sA', 'sB', 'sC'])
+	>>> index.extend(('1', 1), ['A', 'A', 'A'])
+	>>> index.extend(('1', 2), ['C', 'C', 'T'])
+	>>> index.extend(('1', 3), ['G', 'G', 'C'])
+	>>> index.extend(('1', 4), ['T', None, None])
+	>>> index.privates(['sC'])
+	(('1', 2), ('1', 3))
+	>>> index.privates(['sA', 'sB'])
+	(('1', 2), ('1', 3))
+
+	To get a private while ignoring some samples:
+
+	>>> index.privates(['sA'], ignore=['sB'])
+	(('1', 2), ('1', 3), ('1', 4))
+
+	Positions where a group shares a genotype, whatever the others have:
+
+	>>> index.shared(['sA', 'sB'])
+	(('1', 1), ('1', 2), ('1', 3))
+
+	Positions can be added in any order, regions work the same:
+
+	>>> unsorted = PrivatesIndex(['sA', 'sB'])
+	>>> for CHROM in ['1', '2', '9', '10', '11']:
+	...     unsorted.extend((CHROM, 100), ['A', 'C'])
+	>>> unsorted.privates(['sA'], region=('10', 0, 1000))
+	(('10', 100),)
+	>>> unsorted.shared(['sB'], region=('9', 0, 1000))
+	(('9', 100),)
+
+	Many positions can be added at once, as a 2-D array of
+	genotype codes (positions x samples, negative for missing):
+
+	>>> index.extend_block([('1', 5), ('1', 6)], [[0, 0, 1], [2, -1, 2]])
+
+	How genotypes are compared is decided once, when the index is built:
+
+	>>> index = PrivatesIndex(['sA', 'sB', 'sC'], alleles_only=True, missing='wildcard')
+	>>> index.extend(('1', 7), ['0|1', '1/0', '0/1/1'])
+	>>> index.extend(('1', 8), ['1/1', './.', '0/0'])
+	>>> index.privates(['sA', 'sB', 'sC'])
+	(('1', 7),)
+	>>> index.privates(['sA', 'sB'])
+	(('1', 8),)
+
+	Samples that have no data for a position (sC, whose file lacks it) 
+	are not missing calls, they never join a class:
+
+	>>> index.extend_rows(index.document_rows([{'CHROM': '1', 'POS': 9, 
+	...     'samples': {'sA': {'GT': ['A', '/', 'A']}, 'sB': {'GT': ['.', '/', '.']}}}]))
+	>>> index.privates(['sA', 'sB'])
+	(('1', 8), ('1', 9))
+	"""
+
+	def __init__(self, sample_names, phased=False, alleles_only=False, missing='exclude'):
+		if missing not in MISSING_POLICIES:
+			raise ValueError('unknown missing calls policy `{}`.'.format(missing))
+		self.phased = phased
+		self.alleles_only = alleles_only
+		self.missing = missing
+		self.samples = list(sample_names)
+		self._sample_mapping = dict((name, i) for i, name in enumerate(self.samples))
+		self._nodes = defaultdict(PositionList)
+		self._positions = []
+		self._sorted = True
+		self._postings = None
+
+	@property
+	def size(self):
+		return len(self._positions)
+
+	def extend(self, position, value_list):
+		"""Adds a single position, `value_list` has one genotype per
+		sample (see genotype_key()), None for missing calls."""
+		assert len(value_list) == len(self.samples), \
+			"Mismatch between the number of values and the number of samples."
+
+		equivalence_classes = defaultdict(int)
+		missing = 0
+		for i, value in enumerate(value_list):
+			value = genotype_key(value, self.phased, self.alleles_only)
+			if value is None:
+				missing |= 1 << i
+				continue
+			#else
+			equivalence_classes[value] |= 1 << i
+
+		if self.missing == 'exclude':
+			missing = 0
+
+		row = len(self._positions)
+		self._check_order([position])
+		self._positions.append(position)
+		for key in equivalence_classes.values():
+			self._nodes[key | missing].append(row)
+
+	def extend_block(self, positions, codes):
+		"""Adds many positions at once. `codes` is a 2-D array (positions
+		x samples) of integer genotype codes, equal codes on the same row
+		mean equal genotypes, MISSING_CALL and NO_DATA are negative (the
+		comparison policies are expected to be already applied to the
+		codes, except for the missing calls one).
+		Class bitmasks are computed with one vectorized pass per distinct
+		code in the block, then the rows of each class are appended in bulk."""
+		codes = np.asarray(codes)
+		assert codes.ndim == 2 and codes.shape == (len(positions), len(self.samples)), \
+			"Mismatch between the shape of the block and the number of positions or samples."
+
+		first_row = len(self._positions)
+		self._check_order(positions)
+		self._positions.extend(positions)
+
+		# Bitmasks are packed in 64 bit words (bit i of the mask is bit
+		# i%64 of word i//64), hashed to group rows with the same mask.
+		num_words = (len(self.samples) + 63) // 64
+		weights = np.array(HASH_WEIGHTS[:num_words], dtype=np.uint64)
+
+		all_rows = []
+		all_words = []
+		remaining = codes >= 0
+		missing = codes == MISSING_CALL if self.missing == 'wildcard' else None
+		while remaining.any():
+			# One genotype code at a time, there are only a few per block.
+			members = codes == codes.flat[np.argmax(remaining)]
+			remaining &= ~members
+			rows = np.flatnonzero(members.any(axis=1))
+			if missing is not None:
+				members |= missing
+			packed = np.zeros((len(rows), num_words * 8), dtype=np.uint8)
+			packed[:, :(len(self.samples) + 7) // 8] = np.packbits(members[rows], axis=1, bitorder='little')
+			all_rows.append(rows + first_row)
+			all_words.append(packed.view('<u8'))
+
+		if not all_rows:
+			return
+		rows = np.concatenate(all_rows)
+		words = np.concatenate(all_words)
+		with np.errstate(over='ignore'):
+			hashes = (mix64(words) * weights).sum(axis=1, dtype=np.uint64)
+		hashes, first, inverse = np.unique(hashes, return_index=True, return_inverse=True)
+		inverse = inverse.ravel()
+
+		# Hashes could collide: rows that differ from the first row
+		# with the same hash are grouped again, by their whole mask.
+		collisions = np.flatnonzero((words != words[first[inverse]]).any(axis=1))
+		if len(collisions):
+			masks = np.ascontiguousarray(words[collisions]).view(np.dtype((np.void, num_words * 8))).ravel()
+			_, masks_first, masks_inverse = np.unique(masks, return_index=True, return_inverse=True)
+			inverse[collisions] = len(first) + masks_inverse.ravel()
+			first = np.concatenate((first, collisions[masks_first]))
+
+		# Rows sorted by group, then by row number.
+		order = np.lexsort((rows, inverse))
+		bounds = np.concatenate(([0], np.cumsum(np.bincount(inverse, minlength=len(first)))))
+		grouped_rows = rows[order]
+
+		masks = words[first].astype('<u8').tobytes()
+		step = num_words * 8
+		for k in range(len(first)):
+			key = int(binascii.hexlify(masks[k * step:(k + 1) * step][::-1]), 16)
+			self._nodes[key].extend(grouped_rows[bounds[k]:bounds[k + 1]])
+
+	@classmethod
+	def from_matrix(cls, matrix, phased=False, alleles_only=False, missing='exclude', block_size=BLOCK_SIZE):
+		"""Builds the index from a vcf_genotypes.GenotypeMatrix."""
+		index = cls(matrix.samples, phased, alleles_only, missing)
+		for start in range(0, matrix.shape[0], block_size):
+			rows = slice(start, start + block_size)
+			index.extend_block([(matrix.contigs[c], int(p)) for c, p in zip(matrix.CHROMs[rows], matrix.POSs[rows])],
+				matrix.genotype_codes(not phased, rows, alleles_only))
+		return index
+
+	def extend_rows(self, rows, block_size=BLOCK_SIZE):
+		"""Adds (position, codes) tuples, `block_size` at a time
+		through extend_block()."""
+		positions = []
+		block = []
+		for position, codes in rows:
+			positions.append(position)
+			block.append(codes)
+			if len(block) == block_size:
+				self.extend_block(positions, block)
+				positions = []
+				block = []
+		if block:
+			self.extend_block(positions, block)
+
+	def record_rows(self, multirecords, samples_per_file):
+		"""Turns `parse_records_together` output into rows for extend_rows(),
+		only looking at GTs. Alleles are compared as bases, as different
+		files might number the ALT alleles differently."""
+		offsets = [sum(samples_per_file[:i]) for i in range(len(samples_per_file))]
+		for multirecord in multirecords:
+			row = [NO_DATA] * len(self.samples)
+			codes = {}
+			keys = {}
+			for i, record in multirecord:
+				alleles = [record.REF] + record.ALT
+				for k, sample in enumerate(record.samples):
+					GT = sample.get('GT')
+					if GT is None:
+						row[offsets[i] + k] = MISSING_CALL
+						continue
+					if (i, GT) not in keys:
+						keys[i, GT] = genotype_key([x if x in '|/.' else alleles[int(x)] for x in re.split(r'([|/])', GT)],
+												self.phased, self.alleles_only)
+					key = keys[i, GT]
+					row[offsets[i] + k] = MISSING_CALL if key is None else codes.setdefault(key, len(codes))
+			yield (record.CHROM, record.POS), row
+
+	def document_rows(self, documents):
+		"""Turns collection documents into rows for extend_rows(). Samples
+		missing from a document have no data, same as vcf_private.privates_classes()."""
+		for document in documents:
+			row = [NO_DATA] * len(self.samples)
+			codes = {}
+			for j, sample in enumerate(self.samples):
+				if sample not in document['samples']:
+					continue
+				key = genotype_key(document['samples'][sample].get('GT'), self.phased, self.alleles_only)
+				row[j] = MISSING_CALL if key is None else codes.setdefault(key, len(codes))
+			yield (document['CHROM'], document['POS']), row
+
+	@classmethod
+	def merge(cls, indexes):
+		"""Joins indexes of the same samples built with the same policies
+		over consecutive sets of positions (eg. one per contig)."""
+		merged = None
+		for index in indexes:
+			if merged is None:
+				merged = cls(index.samples, index.phased, index.alleles_only, index.missing)
+			assert index.samples == merged.samples and index.policy == merged.policy, \
+				"Only indexes of the same samples, built with the same policies, can be merged."
+			first_row = len(merged._positions)
+			merged._sorted = merged._sorted and index._sorted
+			merged._check_order(index._positions[:1])
+			merged._positions.extend(index._positions)
+			for key, rows in index._nodes.items():
+				merged._nodes[key].extend(rows.to_array() + first_row)
+		return merged
+
+	@property
+	def policy(self):
+		return {'phased': self.phased, 'alleles_only': self.alleles_only, 'missing': self.missing}
+
+
+	#
+	# STORAGE
+	#
+
+	# An index file is a .npz archive: `info` (JSON with the samples, the
+	# policies, the contigs and the number of positions), the positions as `CHROMs`/`POSs` arrays,
+	# the class bitmasks in `keys` (one row of little endian 64 bit words
+	# per key) with the number of positions of each key in `counts`, then
+	# all the (compressed) position lists one after the other in `data`,
+	# each one starting at its entry of `offsets`.
+
+	def save(self, path):
+		contigs = []
+		contig_ids = {}
+		for CHROM, _ in self._positions:
+			if CHROM not in contig_ids:
+				contig_ids[CHROM] = len(contigs)
+				contigs.append(CHROM)
+
+		num_words = (len(self.samples) + 63) // 64
+		keys = sorted(self._nodes)
+		info = dict(self.policy, samples=self.samples, contigs=contigs, positions=len(self._positions))
+		with open(path, 'wb') as f:
+			np.savez(f,
+				info=np.frombuffer(json.dumps(info).encode('utf-8'), dtype=np.uint8),
+				CHROMs=np.array([contig_ids[CHROM] for CHROM, _ in self._positions], dtype=np.int32),
+				POSs=np.array([POS for _, POS in self._positions], dtype=np.int64),
+				keys=np.frombuffer(b''.join(binascii.unhexlify('{:0{}x}'.format(key, num_words * 16))[::-1] for key in keys),
+					dtype='<u8').reshape(len(keys), num_words),
+				counts=np.array([len(self._nodes[key]) for key in keys], dtype=np.int64),
+				offsets=np.cumsum([0] + [self._nodes[key].nbytes for key in keys], dtype=np.int64),
+				data=np.frombuffer(b''.join(bytes(self._nodes[key].data) for key in keys), dtype=np.uint8))
+
+	@classmethod
+	def load(cls, path):
+		with np.load(path) as data:
+			info = json.loads(data['info'].tobytes().decode('utf-8'))
+			index = cls(info['samples'], info['phased'], info['alleles_only'], info['missing'])
+			contigs = info['contigs']
+			positions = [(contigs[c], POS) for c, POS in zip(data['CHROMs'].tolist(), data['POSs'].tolist())]
+			index._check_order(positions)
+			index._positions = positions
+			masks = data['keys'].astype('<u8').tobytes()
+			step = data['keys'].shape[1] * 8
+			counts = data['counts'].tolist()
+			offsets = data['offsets'].tolist()
+			lists = data['data'].tobytes()
+			for k in range(len(counts)):
+				key = int(binascii.hexlify(masks[k * step:(k + 1) * step][::-1]), 16)
+				index._nodes[key] = PositionList(lists[offsets[k]:offsets[k + 1]], counts[k])
+		return index
+
+	def privates(self, private_group, ignore=None, region=None):
+		"""Positions where `private_group` has a private genotype. With
+		`region`, a (CHROM, START, END) tuple, only the rows of the region
+		are decoded if the positions were added in order (CHROMs compared
+		as strings), otherwise all the positions are filtered."""
+		key = self._mask(private_group)
+		rows = self._region_rows(region)
+
+		if ignore is None:
+			lists = [self._nodes[key]] if key in self._nodes else []
+		else:
+			# All classes containing the group and possibly some ignored samples.
+			allowed = key | self._mask(ignore)
+			lists = [self._nodes[node] for node in self._nodes if node & key == key and not node & ~allowed]
+
+		return self._region_positions(PositionList.union(lists, rows).tolist(), region)
+
+	def shared(self, group, region=None):
+		"""Positions where all of `group` have the same genotype, whatever
+		the other samples have: the rows of every class that is a superset
+		of the group. Candidate classes come from the postings of the group
+		member found in the fewest classes, the others are never looked at."""
+		key = self._mask(group)
+		postings = self._sample_postings()
+		candidates = min((postings.get(self._sample_mapping[name], ()) for name in group), key=len)
+		lists = [self._nodes[node] for node in candidates if node & key == key]
+		return self._region_positions(PositionList.union(lists, self._region_rows(region)).tolist(), region)
+
+	def _sample_postings(self):
+		"""Sample number -> keys of the classes it belongs to. Built on first
+		use and again only if classes were added since, keys never go away."""
+		if self._postings is None or self._postings[0] != len(self._nodes):
+			postings = defaultdict(list)
+			for node in self._nodes:
+				remaining = node
+				while remaining:
+					lowest = remaining & -remaining
+					postings[lowest.bit_length() - 1].append(node)
+					remaining ^= lowest
+			self._postings = (len(self._nodes), postings)
+		return self._postings[1]
+
+	def _check_order(self, positions):
+		"""Clears the sorted flag if `positions`, about to be appended,
+		are not in order after the current ones."""
+		if not self._sorted or not positions:
+			return
+		#else
+		if self._positions and positions[0] < self._positions[-1]:
+			self._sorted = False
+		elif any(b < a for a, b in zip(positions, itertools.islice(positions, 1, None))):
+			self._sorted = False
+
+	def _region_rows(self, region):
+		"""The rows of a region, as a slice, when the positions are sorted."""
+		if region is None or not self._sorted:
+			return slice(None)
+		#else
+		CHROM, start, end = region
+		return slice(bisect.bisect_left(self._positions, (CHROM, start)), 
+					bisect.bisect_right(self._positions, (CHROM, end)))
+
+	def _region_positions(self, rows, region):
+		"""Positions of some rows, filtered by region when the rows
+		couldn't be restricted by _region_rows()."""
+		positions = (self._positions[row] for row in rows)
+		if region is None or self._sorted:
+			return tuple(positions)
+		#else
+		CHROM, start, end = region
+		return tuple((c, POS) for c, POS in positions if c == CHROM and start <= POS <= end)
+
+	def _mask(self, names):
+		mask = 0
+		for name in names:
+			mask |= 1 << self._sample_mapping[name]
+		return mask
+
+
+
+def genotype_key(GT, phased=False, alleles_only=False):
+	"""Returns the value that makes two calls equal under a comparison
+	policy, None for missing calls. `GT` can be a string (`0|1`) or a
+	list of alleles and separators, as stored by vcf_import.merge_records()
+	(['A', '|', 'C']). Any other value is compared as it is."""
+	if GT is None:
+		return None
+	if isinstance(GT, list):
+		alleles = [x for x in GT if x not in '|/']
+		separators = [x for x in GT if x in '|/']
+	elif isinstance(GT, str):
+		alleles = re.split(r'[|/]', GT)
+		separators = re.findall(r'[|/]', GT)
+	else:
+		return GT
+
+	if all(x == '.' for x in alleles):
+		return None
+	if alleles_only:
+		return tuple(sorted(set(x for x in alleles if x != '.')))
+	if phased:
+		return tuple(alleles), tuple(separators)
+	return tuple(sorted(alleles))
+
+
+
+def mix64(words):
+	"""splitmix64 finalizer, spreads every bit of a
+	word over the whole word before hashing."""
+	with np.errstate(over='ignore'):
+		words = words ^ (words >> np.uint64(30))
+		words = words * np.uint64(0xbf58476d1ce4e5b9)
+		words = words ^ (words >> np.uint64(27))
+		words = words * np.uint64(0x94d049bb133111eb)
+		return words ^ (words >> np.uint64(31))
+
+
+
+#
+# POSITION LISTS
+#
+
+class PositionList(object):
+	"""Append-only sorted list of row numbers, stored as varint encoded
+	deltas (1 byte for gaps under 128, 2 under 16384...). Skip pointers
+	(every SKIP_INTERVAL rows) are built when a range is first asked for,
+	so that only the blocks of a range are decoded.
+
+	>>> rows = PositionList()
+	>>> rows.extend([3, 5, 300])
+	>>> rows.append(301)
+	>>> len(rows), rows.nbytes, rows.tolist()
+	(4, 5, [3, 5, 300, 301])
+	>>> rows.between(4, 301).tolist()
+	[5, 300]
+	>>> PositionList.union([rows, PositionList([1, 5])]).tolist()
+	[1, 3, 5, 300, 301]
+	>>> rows.intersection(PositionList([1, 5, 301])).tolist()
+	[5, 301]
+	"""
+	__slots__ = ('data', '_length', '_last', '_skips')
+
+	def __init__(self, data=b'', length=0):
+		if isinstance(data, (bytes, bytearray)):
+			self.data = data
+			self._length = length
+			self._last = None if length else -1
+		else:
+			self.data = bytearray()
+			self._length = 0
+			self._last = -1
+			self.extend(data)
+		self._skips = None
+
+	def __len__(self):
+		return self._length
+
+	def __iter__(self):
+		return iter(self.tolist())
+
+	def __eq__(self, other):
+		return isinstance(other, PositionList) and len(self) == len(other) and self.data == other.data
+
+	def __ne__(self, other):
+		return not self == other
+
+	def __repr__(self):
+		return 'PositionList({})'.format(self.tolist())
+
+	@property
+	def nbytes(self):
+		return len(self.data)
+
+	def append(self, row):
+		if self._last is None or not isinstance(self.data, bytearray):
+			return self.extend((row,))
+		delta = row - self._last if self._length else row
+		while delta >= 0x80:
+			self.data.append(delta & 0x7f | 0x80)
+			delta >>= 7
+		self.data.append(delta)
+		self._last = row
+		self._length += 1
+		self._skips = None
+
+	def extend(self, rows):
+		"""Appends rows bigger than the last one, in increasing order."""
+		if self._last is None:
+			self._last = int(self.to_array()[-1])
+		if not isinstance(self.data, bytearray):
+			self.data = bytearray(self.data)
+
+		if len(rows) > 32:
+			rows = np.asarray(rows, dtype=np.int64)
+			self.data += encode_varints(np.diff(rows, prepend=self._last) if self._length else np.diff(rows, prepend=0))
+			self._last = int(rows[-1])
+		else:
+			previous = self._last if self._length else 0
+			for row in rows:
+				row = int(row)
+				delta = row - previous
+				while delta >= 0x80:
+					self.data.append(delta & 0x7f | 0x80)
+					delta >>= 7
+				self.data.append(delta)
+				previous = row
+			self._last = previous
+		self._length += len(rows)
+		self._skips = None
+
+	def to_array(self):
+		return np.cumsum(decode_varints(self.data))
+
+	def tolist(self):
+		return self.to_array().tolist()
+
+	def between(self, start, stop):
+		"""Rows in [start, stop) as an array, decoding only the
+		blocks that can contain them."""
+		if self._length <= SKIP_INTERVAL:
+			rows = self.to_array()
+			return rows[(rows >= start) & (rows < stop)]
+
+		if self._skips is None:
+			# Last row before each block and byte offset of the block.
+			rows = self.to_array()
+			ends = np.flatnonzero(np.frombuffer(bytes(self.data), dtype=np.uint8) < 0x80) + 1
+			blocks = np.arange(SKIP_INTERVAL, self._length, SKIP_INTERVAL)
+			self._skips = (np.concatenate(([0], rows[blocks - 1])), np.concatenate(([0], ends[blocks - 1])))
+
+		previous, offsets = self._skips
+		first = max(np.searchsorted(previous, start, side='left') - 1, 0)
+		last = np.searchsorted(previous, stop, side='left')
+		end = offsets[last] if last < len(offsets) else len(self.data)
+		rows = np.cumsum(decode_varints(self.data[offsets[first]:end])) + (previous[first] if first else 0)
+		return rows[(rows >= start) & (rows < stop)]
+
+	def intersection(self, other):
+		"""Rows in both lists, the longer one is only decoded
+		in the range of the shorter one."""
+		small, big = (self, other) if len(self) <= len(other) else (other, self)
+		if not len(small):
+			return np.empty(0, dtype=np.int64)
+		rows = small.to_array()
+		return np.intersect1d(rows, big.between(rows[0], rows[-1] + 1), assume_unique=True)
+
+	@staticmethod
+	def union(lists, rows=slice(None)):
+		"""Sorted rows found in any of the lists, optionally
+		restricted to a slice of rows."""
+		if rows.start is None and rows.stop is None:
+			arrays = [rows.to_array() for rows in lists]
+		else:
+			start = rows.start or 0
+			stop = rows.stop if rows.stop is not None else np.iinfo(np.int64).max
+			arrays = [rows.between(start, stop) for rows in lists]
+		if not arrays:
+			return np.empty(0, dtype=np.int64)
+		if len(arrays) == 1:
+			return arrays[0]
+		return np.unique(np.concatenate(arrays))
+
+
+def encode_varints(values):
+	"""Non negative integers to LEB128 bytes, 7 bits per byte
+	with the high bit set on all the bytes of a value but the last."""
+	values = np.asarray(values, dtype=np.uint64)
+	lengths = np.ones(len(values), dtype=np.int64)
+	rest = values >> np.uint64(7)
+	while rest.any():
+		lengths += rest > 0
+		rest >>= np.uint64(7)
+
+	owners = np.repeat(np.arange(len(values)), lengths)
+	shifts = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+	encoded = ((values[owners] >> (np.uint64(7) * shifts.astype(np.uint64))) & np.uint64(0x7f)).astype(np.uint8)
+	encoded[shifts < lengths[owners] - 1] |= 0x80
+	return encoded.tobytes()
+
+
+def decode_varints(data):
+	"""Inverse of encode_varints(), returns an int64 array."""
+	encoded = np.frombuffer(bytes(data), dtype=np.uint8)
+	if not len(encoded):
+		return np.empty(0, dtype=np.int64)
+	last_bytes = encoded < 0x80
+	starts = np.flatnonzero(np.concatenate(([True], last_bytes[:-1])))
+	shifts = np.arange(len(encoded)) - np.repeat(starts, np.diff(np.append(starts, len(encoded))))
+	parts = (encoded & 0x7f).astype(np.uint64) << (np.uint64(7) * shifts.astype(np.uint64))
+	return np.add.reduceat(parts, starts).astype(np.int64)
+
+
+
+#
+# STATISTICS
+#
+
+def index_stats(path, top=10):
+	"""Summary of the shape of an index file. Only the keys and their
+	counts are read, never the position lists. Returns a dict with:
+	`positions`, `samples`, `keys`: totals;
+	`bytes`, `bytes_per_key`: size of the keys, counts and compressed position lists;
+	`class_sizes`: {number of samples: [keys, positions]};
+	`top_groups`: the `top` keys with most positions, as ([samples], positions);
+	`singletons`: {sample: positions where its genotype is unique}."""
+	with np.load(path) as data:
+		info = json.loads(data['info'].tobytes().decode('utf-8'))
+		keys = data['keys']
+		counts = data['counts']
+		stored = sum(data.zip.getinfo(name + '.npy').file_size for name in ('keys', 'counts', 'offsets', 'data'))
+		# Files saved before `positions` was stored in `info`.
+		positions = info.get('positions', len(data['POSs']))
+
+	samples = info['samples']
+	members = np.unpackbits(keys.astype('<u8').view(np.uint8), axis=1, bitorder='little')[:, :len(samples)].astype(bool)
+	sizes = members.sum(axis=1)
+
+	class_sizes = {}
+	for size in np.unique(sizes).tolist():
+		selected = sizes == size
+		class_sizes[size] = [int(selected.sum()), int(counts[selected].sum())]
+
+	top_groups = [([samples[j] for j in np.flatnonzero(members[k])], int(counts[k])) 
+					for k in np.argsort(-counts, kind='mergesort')[:top]]
+
+	singletons = dict((sample, 0) for sample in samples)
+	for k in np.flatnonzero(sizes == 1):
+		singletons[samples[int(np.flatnonzero(members[k])[0])]] = int(counts[k])
+
+	return {
+		'positions': positions,
+		'samples': len(samples),
+		'keys': len(counts),
+		'bytes': stored,
+		'bytes_per_key': stored / len(counts) if len(counts) else 0,
+		'class_sizes': class_sizes,
+		'top_groups': top_groups,
+		'singletons': singletons
+	}
+
+
+
+#
+# PARALLEL BUILD
+#
+
+# The positions are split in shards by CHROM, each worker process builds
+# one partial index per CHROM of its shards and the partial indexes are
+# merged in CHROM order (compared as strings, same as the parser does).
+
+def build_from_vcf_files(vcf_filenames, workers=1, phased=False, alleles_only=False, missing='exclude',
+	block_size=BLOCK_SIZE, sort=False):
+	"""Builds the index of some VCF files using `workers` processes, without
+	going through the database. Each process reads all the files but only
+	parses the lines of its CHROMs, and only their GTs. With `sort` the
+	records are sorted before being merged (see parse_records_together()),
+	which is also done anyway, by a second pass, for shards whose records
+	turn out not to be in order."""
+	samples = []
+	for filename in vcf_filenames:
+		with open_vcf(filename) as f:
+			samples.extend(parse_headers(f)[1])
+	assert len(samples) == len(set(samples)), \
+		"Some sample names are colliding. Check your VCF files, aborting."
+
+	policy = {'phased': phased, 'alleles_only': alleles_only, 'missing': missing}
+	tasks = [(vcf_filenames, shard, workers, policy, block_size, sort) for shard in range(workers)]
+	return _merge_shards(PrivatesIndex(samples, **policy), _run(_vcf_shard, tasks, workers))
+
+
+def build_from_collection(db, collection, workers=1, samples=None, phased=False, alleles_only=False, missing='exclude',
+	block_size=BLOCK_SIZE):
+	"""Builds the index of a collection using `workers` processes, one CHROM at a time."""
+	from vcf_query import check_position_index, collection_contigs, collection_samples
+
+	if samples is None:
+		samples = sorted(collection_samples(db, collection))
+	check_position_index(db, collection)
+	policy = {'phased': phased, 'alleles_only': alleles_only, 'missing': missing}
+	tasks = [((db.host, db.port, db.db), collection, CHROM, samples, policy, block_size) 
+				for CHROM in collection_contigs(db, collection)]
+	return _merge_shards(PrivatesIndex(samples, **policy), _run(_collection_shard, tasks, workers))
+
+
+def open_vcf(filename):
+	if filename.endswith('.gz'):
+		return gzip.open(filename, 'rt')
+	return open(filename, 'r')
+
+
+def _run(function, tasks, workers):
+	if workers <= 1:
+		return [function(task) for task in tasks]
+	#else
+	pool = multiprocessing.Pool(workers)
+	try:
+		return pool.map(function, tasks, chunksize=1)
+	finally:
+		pool.close()
+		pool.join()
+
+
+def _merge_shards(empty_index, shards):
+	partial_indexes = sorted((partial for shard in shards for partial in shard), key=lambda partial: partial[0])
+	return PrivatesIndex.merge([empty_index] + [index for _, index in partial_indexes])
+
+
+def _vcf_shard(task):
+	vcf_filenames, shard, num_shards, policy, block_size, sort = task
+	try:
+		return _vcf_shard_indexes(vcf_filenames, shard, num_shards, policy, block_size, sort)
+	except UnsortedFile:
+		if sort:
+			raise
+		#else
+		return _vcf_shard_indexes(vcf_filenames, shard, num_shards, policy, block_size, True)
+
+
+def _vcf_shard_indexes(vcf_filenames, shard, num_shards, policy, block_size, sort):
+
+	def shard_lines(filestream):
+		for line in filestream:
+			CHROM = line[:line.index('\t')]
+			if zlib.crc32(CHROM.encode('utf-8')) % num_shards == shard:
+				yield line
+
+	filestreams = [open_vcf(filename) for filename in vcf_filenames]
+	try:
+		headers, samples = zip(*(parse_headers(f) for f in filestreams))
+		records = parse_records_together([(shard_lines(f), h) for f, h in zip(filestreams, headers)], 
+					genotypes_only=True, sort=sort)
+
+		partial_indexes = []
+		samples_per_file = [len(file_samples) for file_samples in samples]
+		prototype = PrivatesIndex([s for file_samples in samples for s in file_samples], **policy)
+		for CHROM, rows in itertools.groupby(prototype.record_rows(records, samples_per_file), lambda row: row[0][0]):
+			index = PrivatesIndex(prototype.samples, **policy)
+			index.extend_rows(rows, block_size)
+			partial_indexes.append((CHROM, index))
+		return partial_indexes
+	finally:
+		for f in filestreams:
+			f.close()
+
+
+def _collection_shard(task):
+	(host, port, db_name), collection, CHROM, samples, policy, block_size = task
+	import rethinkdb as r
+	from vcf_query import region_query
+
+	db = r.connect(host=host, port=port, db=db_name)
+	try:
+		index = PrivatesIndex(samples, **policy)
+		documents = region_query(collection, (CHROM, r.minval, r.maxval)) \
+						.pluck('CHROM', 'POS', {'samples': {s: ['GT'] for s in samples}}).run(db)
+		index.extend_rows(index.document_rows(documents), block_size)
+		return [(CHROM, index)]
+	finally:
+		db.close()
+
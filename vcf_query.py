@@ -0,0 +1,415 @@
+from __future__ import print_function
+import re
+try:
+	import rethinkdb as r
+except:
+	print('Unable to import the RethinkDB python module.')
+	print('To install: pip install rethinkdb')
+	print('\n')
+	raise ImportError
+from vcf_miniparser import Headers, header_schema, schema_hash
+
+
+# Record ids are `CHROM-POS` strings, so the primary index sorts
+# them lexicographically (`1-100` < `1-20`). Genomic order comes
+# from a compound [CHROM, POS] secondary index instead.
+# CHROMs are compared as strings, same as the parser does while
+# walking multiple VCF files together.
+
+POSITION_INDEX = 'CHROM_POS'
+
+
+def create_position_index(db, collection):
+	"""Creates the [CHROM, POS] index, meant to be called right
+	after the creation of the collection's table."""
+	r.table(collection).index_create(POSITION_INDEX, [r.row['CHROM'], r.row['POS']]).run(db)
+
+
+
+def check_position_index(db, collection):
+	"""Makes sure the [CHROM, POS] index exists (collections created before
+	it was introduced get it built now) and waits for it to be ready."""
+	if POSITION_INDEX not in r.table(collection).index_list().run(db):
+		print('# Building the {} index for collection {}, this is done only once.'.format(POSITION_INDEX, collection))
+		create_position_index(db, collection)
+	r.table(collection).index_wait(POSITION_INDEX).run(db)
+
+
+
+def parse_region(region):
+	"""Parses `CHROM`, `CHROM:START` or `CHROM:START-END` (1-based, inclusive)
+	into a (CHROM, START, END) tuple. Missing bounds are left open.
+	Raises ValueError if the region is malformed."""
+	chrom, _, interval = region.partition(':')
+	start, _, end = interval.replace(',', '').partition('-')
+	if not chrom:
+		raise ValueError('malformed region `{}`.'.format(region))
+	try:
+		start = int(start) if start else r.minval
+		end = int(end) if end else r.maxval
+	except ValueError:
+		raise ValueError('malformed region `{}`.'.format(region))
+	return chrom, start, end
+
+
+
+def region_query(collection, region=None):
+	"""Returns the records of a collection in genomic order, optionally
+	restricted to a region (either a string accepted by parse_region() or
+	a (CHROM, START, END) tuple). Usage:
+
+	>>>> check_position_index(db, 'mycollection')
+	>>>> for record in region_query('mycollection', '20:14000-18000').run(db):
+	...      print(record['POS'])
+	"""
+	query = r.table(collection)
+	if region is not None:
+		chrom, start, end = region if isinstance(region, tuple) else parse_region(region)
+		query = query.between([chrom, start], [chrom, end], index=POSITION_INDEX, right_bound='closed')
+	return query.order_by(index=POSITION_INDEX)
+
+
+
+def collection_contigs(db, collection):
+	"""Returns the CHROMs of a collection in [CHROM, POS] index
+	order, with one index lookup per CHROM instead of a full scan."""
+	contigs = []
+	query = r.table(collection)
+	while True:
+		first = list(query.order_by(index=POSITION_INDEX).limit(1)['CHROM'].run(db))
+		if not first:
+			return contigs
+		contigs.append(first[0])
+		query = r.table(collection).between([first[0], r.maxval], r.maxval, index=POSITION_INDEX)
+
+
+
+#
+# METADATA
+#
+
+# The document of a collection in __METADATA__ only holds its state 
+# flags, counters and the header schemas in use. VCF files and samples 
+# have one document each in __VCFS__ and __SAMPLES__ (ids are 
+# [collection, name]), so appending files only writes what is added.
+# Records don't repeat the (possibly long) VCF filenames: every file
+# gets a small integer `file_id` when imported and its ID, QUAL, FILTER
+# and INFO values are keyed by that number (as a string). Collections
+# imported before the ids existed keep using the filenames as keys.
+
+def init_metadata_tables(db):
+	"""Creates the per-file and per-sample metadata tables if missing."""
+	table_list = r.table_list().run(db)
+	if '__VCFS__' not in table_list:
+		r.table_create('__VCFS__').run(db)
+		r.table('__VCFS__').index_create('collection').run(db)
+	if '__SAMPLES__' not in table_list:
+		r.table_create('__SAMPLES__').run(db)
+		r.table('__SAMPLES__').index_create('collection').run(db)
+		r.table('__SAMPLES__').index_create('vcf', [r.row['collection'], r.row['vcf']]).run(db)
+	r.table('__VCFS__').index_wait().run(db)
+	r.table('__SAMPLES__').index_wait().run(db)
+
+
+
+def store_vcfs(db, collection, vcf_filenames, headers, samples):
+	"""Stores the metadata of newly imported VCF files: the header schema
+	of each file goes once in __METADATA__ (shared by all files and 
+	collections with identical headers), files and samples go in their
+	own tables. Every file gets the next free file id of the collection.
+	Returns the keys to use for the files inside the records."""
+	schemas = dict((schema_hash(header_schema(h)), header_schema(h)) for h in headers)
+	r.table('__METADATA__').insert([{'id': ['schema', key], 'schema': schema} for key, schema in schemas.items()], 
+		conflict='replace').run(db)
+
+	first_id = r.table('__VCFS__').get_all(collection, index='collection')\
+					.map(lambda x: x['file_id'].default(-1)).max().default(-1).run(db) + 1
+	vcf_docs = [{
+			'id': [collection, vcf_filenames[i]], 
+			'collection': collection, 
+			'vcf': vcf_filenames[i],
+			'file_id': first_id + i,
+			'fileformat': headers[i].fileformat, 
+			'schema': schema_hash(header_schema(headers[i]))
+		} for i in range(len(headers))]
+	r.table('__VCFS__').insert(vcf_docs, conflict='replace').run(db)
+
+	r.table('__SAMPLES__').insert([{
+			'id': [collection, sample],
+			'collection': collection,
+			'sample': sample,
+			'vcf': vcf_filenames[i]
+		} for i in range(len(headers)) for sample in samples[i]], conflict='replace').run(db)
+
+	return [file_key(doc) for doc in vcf_docs]
+
+
+
+def collection_vcfs(db, collection):
+	"""Returns a dict VCF filename -> {'fileformat': ..., 'schema': ...}."""
+	return dict((doc['vcf'], doc) for doc in r.table('__VCFS__').get_all(collection, index='collection').run(db))
+
+
+
+def file_key(vcf_entry):
+	"""Returns the key used inside the records for the data of a VCF file, 
+	given its __VCFS__ document."""
+	if 'file_id' in vcf_entry:
+		return str(vcf_entry['file_id'])
+	return vcf_entry['vcf']
+
+
+
+def collection_file_keys(db, collection, vcf_filenames=None):
+	"""Returns a dict VCF filename -> key used inside the records, 
+	optionally only for some of the VCF files."""
+	if vcf_filenames is None:
+		query = r.table('__VCFS__').get_all(collection, index='collection')
+	else:
+		query = r.table('__VCFS__').get_all(*[[collection, vcf] for vcf in vcf_filenames])
+	return dict((doc['vcf'], file_key(doc)) for doc in query.run(db))
+
+
+
+def collection_samples(db, collection, vcf_filenames=None):
+	"""Returns a dict sample name -> VCF filename, optionally 
+	only for the samples coming from some of the VCF files."""
+	if vcf_filenames is None:
+		query = r.table('__SAMPLES__').get_all(collection, index='collection')
+	else:
+		query = r.table('__SAMPLES__').get_all(*[[collection, vcf] for vcf in vcf_filenames], index='vcf')
+	return dict((doc['sample'], doc['vcf']) for doc in query.run(db))
+
+
+
+def delete_vcfs(db, collection, vcf_filenames=None):
+	"""Removes the metadata of some VCF files (and of their samples),
+	or of all the files of a collection."""
+	if vcf_filenames is None:
+		r.table('__VCFS__').get_all(collection, index='collection').delete().run(db)
+		r.table('__SAMPLES__').get_all(collection, index='collection').delete().run(db)
+	else:
+		r.table('__VCFS__').get_all(*[[collection, vcf] for vcf in vcf_filenames]).delete().run(db)
+		r.table('__SAMPLES__').get_all(*[[collection, vcf] for vcf in vcf_filenames], index='vcf').delete().run(db)
+
+
+
+def delete_samples(db, collection, samples):
+	"""Removes the metadata of some samples."""
+	r.table('__SAMPLES__').get_all(*[[collection, sample] for sample in samples]).delete().run(db)
+
+
+
+def upgrade_metadata(db, metadata):
+	"""Moves the `vcfs` and `samples` dicts of collections imported before 
+	the metadata was split into the per-file and per-sample tables.
+	Returns the (possibly updated) collection document."""
+	if metadata is None or 'vcfs' not in metadata:
+		return metadata
+
+	collection = metadata['id']
+	schemas = {}
+	vcfs = []
+	for vcf, entry in metadata['vcfs'].items():
+		if 'schema' not in entry:
+			# Even older collections store a full copy of the headers.
+			schema = header_schema(Headers(**entry))
+			schemas[schema_hash(schema)] = schema
+			entry = {'fileformat': entry['fileformat'], 'schema': schema_hash(schema)}
+		vcfs.append({'id': [collection, vcf], 'collection': collection, 'vcf': vcf, 
+			'fileformat': entry['fileformat'], 'schema': entry['schema']})
+
+	if schemas:
+		r.table('__METADATA__').insert([{'id': ['schema', key], 'schema': schema} for key, schema in schemas.items()], 
+			conflict='replace').run(db)
+	r.table('__VCFS__').insert(vcfs, conflict='replace').run(db)
+	r.table('__SAMPLES__').insert([{'id': [collection, sample], 'collection': collection, 'sample': sample, 'vcf': vcf} 
+		for sample, vcf in metadata['samples'].items()], conflict='replace').run(db)
+
+	r.table('__METADATA__').get(collection).replace(lambda x: x.without('vcfs', 'samples').merge({
+			'vcfs_count': len(vcfs),
+			'samples_count': len(metadata['samples']),
+			'schemas': sorted(set(vcf['schema'] for vcf in vcfs))
+		})).run(db)
+	return r.table('__METADATA__').get(collection).run(db)
+
+
+
+#
+# SUMMARY STATISTICS
+#
+
+# Computed at import time so that QC questions don't need a scan. Every
+# record carries the allele counts of its samples: AN (called alleles),
+# AC and AF (keyed by ALT allele, GTs are stored as bases). Every sample
+# document in __SAMPLES__ carries how many of its calls fall in each of 
+# the SAMPLE_STATS classes (plus transitions and transversions among its
+# ALT SNV alleles) and the collection document the totals. Collections
+# imported before the stats existed have no `stats` in their document.
+
+SAMPLE_STATS = ('hom_ref', 'het', 'hom_alt', 'missing', 'transitions', 'transversions')
+
+def allele_stats(record):
+	"""ReQL: AN, AC and AF of a record computed from its samples, 
+	to merge into it after its samples change."""
+	alleles = record['samples'].values().concat_map(lambda sample: sample['GT'].default([])) \
+				.filter(lambda allele: r.expr(['|', '/', '.']).contains(allele).not_())
+	return alleles.count().do(lambda AN: 
+		alleles.filter(lambda allele: allele != record['REF']).group(lambda allele: allele).count().ungroup() \
+			.map(lambda group: [group['group'], group['reduction']]).coerce_to('object').do(lambda AC: {
+				'AN': AN,
+				'AC': r.literal(AC),
+				'AF': r.literal(AC.keys().map(lambda allele: [allele, AC[allele].div(AN)]).coerce_to('object'))
+			}))
+
+
+
+def store_sample_stats(db, collection, sample_stats):
+	"""Saves the stats of some samples and updates the totals of the 
+	collection, summing again the stats of all its samples."""
+	if sample_stats:
+		r.table('__SAMPLES__').insert([{'id': [collection, sample], 'stats': stats} for sample, stats in sample_stats.items()], 
+			conflict='update').run(db)
+	update_stats_totals(db, collection)
+
+
+
+def update_stats_totals(db, collection):
+	totals = dict((key, 0) for key in SAMPLE_STATS)
+	for stats in collection_sample_stats(db, collection).values():
+		for key in SAMPLE_STATS:
+			totals[key] += stats[key]
+	r.table('__METADATA__').get(collection).update({'stats': r.literal(totals)}).run(db)
+
+
+
+def collection_sample_stats(db, collection):
+	"""Returns a dict sample name -> stats, for the samples that have them."""
+	return dict((doc['sample'], doc['stats']) for doc in 
+		r.table('__SAMPLES__').get_all(collection, index='collection').has_fields('stats').run(db))
+
+
+
+#
+# FIELD INDEXES
+#
+
+# INFO values live under INFOs[vcf][ID] and FORMAT values under 
+# samples[sample][ID]. A field index is a multi index over all the 
+# values of a field in a record (across files and samples), keeping only
+# the values of the type declared in the headers (eg. no `.` in a 
+# numeric field) so that ranges compare numbers with numbers.
+# Indexed fields are listed in the `field_indexes` dict of the 
+# collection document (field -> ReQL type of the indexed values).
+
+FIELD_SECTIONS = ('INFO', 'FORMAT')
+
+
+def parse_field(field):
+	"""Parses `INFO:ID` or `FORMAT:ID` into a (section, ID) 
+	tuple. Raises ValueError if the field is malformed."""
+	section, _, ID = field.partition(':')
+	if section not in FIELD_SECTIONS or not ID:
+		raise ValueError('malformed field `{}`, expected INFO:<ID> or FORMAT:<ID>.'.format(field))
+	return section, ID
+
+
+
+def field_index_name(field):
+	section, ID = parse_field(field)
+	return '{}_{}'.format(section, re.sub(r'[^a-zA-Z0-9_]', '_', ID))
+
+
+
+def field_type(db, collection, field, schemas=None):
+	"""ReQL type (NUMBER, BOOL or STRING) of the values of a field, from its 
+	definitions in the header schemas of the collection (or in `schemas`).
+	Undefined fields are stored as lists of strings."""
+	section, ID = parse_field(field)
+	if schemas is None:
+		hashes = r.table('__METADATA__').get(collection).run(db).get('schemas', [])
+		schemas = [doc['schema'] for doc in r.table('__METADATA__').get_all(*[['schema', h] for h in hashes]).run(db)] \
+					if hashes else []
+
+	types = set()
+	for schema in schemas:
+		definition = schema['infos' if section == 'INFO' else 'formats'].get(ID)
+		types.add(definition[1] if definition else 'String')
+
+	if types and types <= set(['Integer', 'Float']):
+		return 'NUMBER'
+	if types == set(['Flag']):
+		return 'BOOL'
+	return 'STRING'
+
+
+
+def field_values(record, field, value_type):
+	"""ReQL: the distinct values of `value_type` of a field in a record."""
+	section, ID = parse_field(field)
+	containers = record['INFOs'].values() if section == 'INFO' else record['samples'].values()
+	return containers.concat_map(lambda container: 
+				r.branch(container.has_fields(ID), 
+					r.branch(container[ID].type_of().eq('ARRAY'), container[ID], [container[ID]]), 
+					[])) \
+			.filter(lambda value: value.type_of().eq(value_type)).distinct()
+
+
+
+def create_field_index(db, collection, field):
+	"""Builds the multi index of a field and registers it in the 
+	collection metadata. Returns the index name and the indexed type."""
+	name = field_index_name(field)
+	value_type = field_type(db, collection, field)
+	if name in r.table(collection).index_list().run(db):
+		raise ValueError('field `{}` is already indexed.'.format(field))
+
+	r.table(collection).index_create(name, lambda record: field_values(record, field, value_type), multi=True).run(db)
+	r.table('__METADATA__').get(collection).update({'field_indexes': {field: value_type}}).run(db)
+	r.table(collection).index_wait(name).run(db)
+	return name, value_type
+
+
+
+def check_field_indexes(db, collection, headers=None):
+	"""Makes sure that the indexes of the indexed fields exist and are 
+	ready (rebuilding missing ones). With the `headers` of files being 
+	appended, warns about fields they declare with a different type, 
+	since those values will not be indexed."""
+	field_indexes = r.table('__METADATA__').get(collection).run(db).get('field_indexes', {})
+	index_list = r.table(collection).index_list().run(db)
+	for field, value_type in field_indexes.items():
+		name = field_index_name(field)
+		if name not in index_list:
+			print('# Building the {} index for field {}.'.format(name, field))
+			r.table(collection).index_create(name, lambda record: field_values(record, field, value_type), multi=True).run(db)
+
+		if headers is not None:
+			new_type = field_type(db, collection, field, [header_schema(h) for h in headers])
+			if new_type != value_type:
+				print('Warning: field {} is indexed as {} but the new files define it as {}, their values will not be indexed.'.format(
+					field, value_type, new_type))
+
+	if field_indexes:
+		r.table(collection).index_wait(*[field_index_name(field) for field in field_indexes]).run(db)
+
+
+
+def field_range_query(db, collection, field, low=None, high=None):
+	"""Yields the records having at least one value of a field 
+	within [low, high] (missing bounds are left open). Usage:
+
+	>>>> create_field_index(db, 'mycollection', 'INFO:DP')
+	>>>> for record in field_range_query(db, 'mycollection', 'INFO:DP', 10, 50):
+	...      print(record['id'])
+
+	The index holds a record once per value, so a record with many values 
+	in the range comes out of the cursor many times. Duplicates are dropped
+	here while streaming: distinct() would collect the whole range on the
+	server, failing on ranges bigger than the array limit."""
+	seen = set()
+	for record in r.table(collection).between(r.minval if low is None else low, r.maxval if high is None else high, 
+				index=field_index_name(field), right_bound='closed').run(db):
+		if record['id'] not in seen:
+			seen.add(record['id'])
+			yield record